@@ -0,0 +1,299 @@
+"""
+Shared helpers for the analysis scripts in this directory.
+
+Scripts are run as `python3 scripts/<name>.py`, which puts scripts/ on
+sys.path, so they import from here directly:
+
+    from analysis_common import load_columns, fast_fft
+
+This module never imports pyplot at load time, so scripts that select a
+backend (matplotlib.use('Agg')) keep control over it.
+"""
+
+from contextlib import ExitStack
+from functools import lru_cache
+import os
+
+import numpy as np
+import pandas as pd
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+from matplotlib.ticker import FuncFormatter
+from scipy import signal
+from scipy.fft import set_backend, set_workers
+
+# Optional multithreaded CSV reader
+try:
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+
+# Optional CUDA spectral path (cuFFT batched plans)
+try:
+    import cupy
+    import cusignal
+except ImportError:
+    cupy = cusignal = None
+
+# Optional JIT for the numeric kernels
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
+
+# Optional fused int->float decode
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# pyFFTW is optional: when installed it serves as the scipy.fft backend,
+# with its plan cache kept alive across repeated same-shape transforms
+try:
+    import pyfftw
+    from pyfftw.interfaces import scipy_fft as pyfftw_backend
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    FFT_BACKEND = pyfftw_backend
+except ImportError:
+    FFT_BACKEND = None
+
+INV_Q14 = np.float32(1.0 / 16384.0)  # Q4.14 -> float (2^-14)
+PLOT_BUCKETS = 4000  # Min/max buckets per continuous trace (figure is ~2000 px wide)
+
+# FFT
+
+def fast_fft():
+    """Context for heavy FFT work: pyFFTW backend if installed, all CPU cores."""
+    stack = ExitStack()
+    if FFT_BACKEND is not None:
+        stack.enter_context(set_backend(FFT_BACKEND))
+    stack.enter_context(set_workers(-1))
+    return stack
+
+# CSV loading
+
+def column_cache_path(csv_path, column):
+    """Per-column .npy cache file next to the CSV."""
+    return f'{csv_path}.{column}.npy'
+
+def load_columns(csv_path, columns, use_cache=True):
+    """Read only the requested columns that exist in the CSV, as NumPy arrays.
+
+    Uses pyarrow's parallel reader when available, else pandas' C parser.
+    With use_cache, each column is saved as a .npy beside the CSV after the
+    first parse and memory-mapped back on later runs while it is at least
+    as new as the CSV.
+    """
+    with open(csv_path) as fh:
+        header = fh.readline().strip().split(',')
+    present = [c for c in columns if c in header]
+
+    if use_cache:
+        csv_mtime = os.path.getmtime(csv_path)
+        paths = {c: column_cache_path(csv_path, c) for c in present}
+        if all(os.path.exists(p) and os.path.getmtime(p) >= csv_mtime for p in paths.values()):
+            return {c: np.load(p, mmap_mode='r') for c, p in paths.items()}
+
+    if pacsv is not None:
+        table = pacsv.read_csv(csv_path,
+                               convert_options=pacsv.ConvertOptions(include_columns=present))
+        cols = {c: table[c].to_numpy() for c in present}
+    else:
+        df = pd.read_csv(csv_path, usecols=present, engine='c')
+        cols = {c: df[c].to_numpy() for c in present}
+
+    if use_cache:
+        for c, values in cols.items():
+            # Write then rename so an interrupted run never leaves a valid-looking cache
+            tmp_path = paths[c] + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                np.save(fh, values)
+            os.replace(tmp_path, paths[c])
+    return cols
+
+def load_dac(fname, **kwargs):
+    """Load only the dac_output column of a seed CSV as contiguous float32."""
+    df = pd.read_csv(fname, usecols=['dac_output'], dtype={'dac_output': np.float32},
+                     engine='c', **kwargs)
+    return np.ascontiguousarray(df['dac_output'].to_numpy())
+
+def column_arrays(df, names):
+    """NumPy arrays for the named columns, pulled out of pandas once per plot."""
+    return {name: df[name].to_numpy() for name in names}
+
+# Fixed-point decoding
+
+def dac_to_float(dac_raw):
+    """12-bit DAC codes -> float32 in [-1, 1): one fused scale pass plus an in-place offset."""
+    dac_float = np.multiply(dac_raw, np.float32(1.0 / 2048.0), dtype=np.float32)
+    dac_float -= np.float32(1.0)
+    return dac_float
+
+def q14_to_float(raw):
+    """Decode Q4.14 integers to float32 in one pass (numexpr-fused when available)."""
+    raw = np.asarray(raw, dtype=np.int32)
+    if ne is not None:
+        out = np.empty(raw.shape, dtype=np.float32)
+        return ne.evaluate('a * s', local_dict={'a': raw, 's': INV_Q14},
+                           out=out, casting='unsafe')
+    return raw.astype(np.float32) * INV_Q14
+
+# Signal reductions
+
+def to_db(power, eps):
+    """10*log10(power + eps) with a single output allocation."""
+    out = power + eps
+    np.log10(out, out=out)
+    out *= 10
+    return out
+
+@lru_cache(maxsize=None)
+def highpass_sos(fs, cutoff=3.0):
+    """4th-order Butterworth high-pass, designed once per sample rate."""
+    return signal.butter(4, cutoff, btype='high', fs=fs, output='sos')
+
+def rolling_transitions(x, window):
+    """Count value changes within the trailing window before each sample.
+
+    out[i] = number of nonzero diffs in x[i-window:i] (0 for i < window),
+    computed in O(N) from a prefix sum of change flags.
+    """
+    changed = (np.diff(x) != 0).astype(np.int32)
+    csum = np.empty(len(x), dtype=np.int32)
+    csum[0] = 0
+    np.cumsum(changed, out=csum[1:])
+    out = np.zeros(len(x), dtype=np.int32)
+    out[window:] = csum[window-1:-1] - csum[:len(x)-window]
+    return out
+
+def rolling_mean(x, window):
+    """Trailing mean along the last axis, matching rolling(window, min_periods=1).
+
+    Works on a (channels, N) stack in one cumulative-sum pass.
+    """
+    # Accumulate in float64: a float32 prefix sum drifts by ~1% over 200k samples
+    csum = np.cumsum(x, axis=-1, dtype=np.float64)
+    out = np.empty_like(csum)
+    head = min(window, x.shape[-1])
+    # Partial windows at the start average over the samples seen so far
+    out[..., :head] = csum[..., :head] / np.arange(1, head + 1)
+    out[..., window:] = (csum[..., window:] - csum[..., :-window]) / window
+    return out.astype(x.dtype, copy=False)
+
+def minmax_envelope(x, fs, buckets):
+    """Per-bucket min/max of x and bucket start times, for drawing a long trace as a filled band."""
+    chunk = max(1, len(x) // buckets)
+    n = len(x) - len(x) % chunk
+    env = np.asarray(x[:n]).reshape(-1, chunk)
+    return np.arange(env.shape[0]) * chunk / fs, env.min(axis=1), env.max(axis=1)
+
+def decimate_minmax(x, y, target=PLOT_BUCKETS):
+    """Min/max decimation for line plots.
+
+    Traces longer than 4*target are split into target buckets and reduced to
+    each bucket's min and max (in time order), which preserves the drawn
+    envelope at a fraction of the points. Shorter traces pass through.
+    """
+    y = np.asarray(y)
+    n = len(y)
+    if n <= 4 * target:
+        return x, y
+    bucket = n // target
+    yb = y[:bucket * target].reshape(target, bucket)
+    lo = yb.argmin(axis=1)
+    hi = yb.argmax(axis=1)
+    start = np.arange(target) * bucket
+    idx = np.empty(2 * target + n - bucket * target, dtype=np.intp)
+    idx[0:2 * target:2] = start + np.minimum(lo, hi)
+    idx[1:2 * target:2] = start + np.maximum(lo, hi)
+    idx[2 * target:] = np.arange(bucket * target, n)  # Leftover tail samples
+    return np.asarray(x)[idx], y[idx]
+
+def band_slice(f, low, high):
+    """Contiguous slice of the monotonic frequency axis f covering [low, high]."""
+    return slice(int(np.searchsorted(f, low, side='left')),
+                 int(np.searchsorted(f, high, side='right')))
+
+def _band_powers_db_numpy(Sxx, lo, hi, eps):
+    """Mean power over rows lo[b]:hi[b] of Sxx for each band, in dB: shape (bands, times)."""
+    return to_db(np.stack([Sxx[l:h].mean(axis=0) for l, h in zip(lo, hi)]), eps)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def band_powers_db(Sxx, lo, hi, eps):
+        """Per-band mean over contiguous frequency rows and dB conversion in one pass."""
+        n_time = Sxx.shape[1]
+        out = np.zeros((lo.size, n_time))
+        for b in prange(lo.size):
+            for fi in range(lo[b], hi[b]):
+                for ti in range(n_time):
+                    out[b, ti] += Sxx[fi, ti]
+            inv = 1.0 / (hi[b] - lo[b])
+            for ti in range(n_time):
+                out[b, ti] = 10.0 * np.log10(out[b, ti] * inv + eps)
+        return out
+else:
+    band_powers_db = _band_powers_db_numpy
+
+# Plotting
+
+def draw_phase_lines(ax, times, **style):
+    """Full-height vertical lines at the phase boundaries as one LineCollection."""
+    ax.add_collection(LineCollection([[(x, 0), (x, 1)] for x in times],
+                                     transform=ax.get_xaxis_transform(), **style),
+                      autolim=False)
+
+def draw_band_lines(ax, t, band_db, colors, labels):
+    """All band curves as one LineCollection; returns proxy handles for the legend."""
+    segs = np.empty(band_db.shape + (2,))
+    segs[..., 0] = t
+    segs[..., 1] = band_db
+    ax.add_collection(LineCollection(segs, colors=colors, linewidths=1.5, alpha=0.8))
+    ax.autoscale_view()
+    return [Line2D([], [], color=c, linewidth=1.5, alpha=0.8, label=l)
+            for c, l in zip(colors, labels)]
+
+def db_colorbar(im, ax, **kwargs):
+    """Colorbar for a LogNorm power image: one tick per decade, labelled in dB."""
+    cbar = ax.figure.colorbar(im, ax=ax, label='Power (dB)', **kwargs)
+    lo, hi = np.log10(im.norm.vmin), np.log10(im.norm.vmax)
+    cbar.set_ticks(np.logspace(lo, hi, int(round(hi - lo)) + 1))
+    cbar.ax.minorticks_off()
+    cbar.ax.yaxis.set_major_formatter(FuncFormatter(lambda v, _: f'{10 * np.log10(v):.0f}'))
+    return cbar
+
+# Dashboard figures reused across render() calls in the same session, per layout
+_FIGURE_CACHE = {}
+
+def dashboard_figure(layout, fig=None, figsize=(14, 12)):
+    """Return (fig, axes) with axes = layout(fig).
+
+    Pass fig to embed the dashboard in an existing figure. Otherwise the
+    figure from a previous call with the same layout is reused while it is
+    still open, clearing its axes instead of rebuilding them (Axes
+    construction dominates re-render time).
+    """
+    import matplotlib.pyplot as plt
+
+    owned = fig is None
+    if owned:
+        cached = _FIGURE_CACHE.get(layout)
+        if cached is not None and plt.fignum_exists(cached[0].number):
+            fig, axes = cached
+            for ax in fig.axes:
+                if ax in axes:
+                    ax.cla()
+                    ax.set_facecolor(plt.rcParams['axes.facecolor'])  # undo per-plot tints
+                else:
+                    ax.remove()  # twinx axes added by the plot functions
+            fig.legends.clear()
+            return fig, axes
+        fig = plt.figure(figsize=figsize)
+    else:
+        fig.clf()
+
+    axes = layout(fig)
+    if owned:
+        _FIGURE_CACHE[layout] = (fig, axes)
+    return fig, axes
@@ -10,26 +10,38 @@ Parses VCD waveforms from tb_state_characterization.v and computes:
 Uses actual FPGA simulation data, not Python approximations.
 """
 
+import json
+import os
 import numpy as np
 import re
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 
 
 def twos_complement(val, bits, signed=True):
-    """Convert unsigned integer to signed (two's complement).
+    """Convert unsigned integer(s) to signed (two's complement).
 
     Args:
-        val: Unsigned integer value
+        val: Unsigned integer value or numpy array of values
         bits: Number of bits
         signed: If True, interpret as signed. If False, return unsigned.
     """
     if not signed:
         return val
-    if val >= 2**(bits-1):
-        return val - 2**bits
-    return val
+    # Widen first: raw buffers are int32 up to 31 bits, where 2**bits would not fit
+    val = np.asarray(val).astype(np.int64, copy=False)
+    return np.where(val >= 1 << (bits - 1), val - (1 << bits), val)
+
+
+def signal_dtype(bits, signed=True):
+    """Smallest numpy integer dtype that holds a `bits`-wide signal."""
+    if bits <= (16 if signed else 15):
+        return np.int16
+    if bits <= (32 if signed else 31):
+        return np.int32
+    return np.int64
 
 
 # Signals that should be interpreted as unsigned
@@ -37,18 +49,84 @@ UNSIGNED_SIGNALS = {'state_select', 'phase_pattern', 'oscillator_derived_pattern
                     'ca3_learning', 'ca3_recalling', 'ca3_debug'}
 
 
-def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000):
+def vcd_cache_paths(vcd_file):
+    """Return (samples .npy, metadata .json) paths of the parse cache for a VCD."""
+    vcd_file = Path(vcd_file)
+    return (vcd_file.with_name(vcd_file.name + '.parse_cache.npy'),
+            vcd_file.with_name(vcd_file.name + '.parse_cache.json'))
+
+
+def load_vcd_cache(vcd_file, signals_of_interest, max_samples):
+    """
+    Open the parse cache of a VCD file if it matches the current request.
+
+    The cache is only valid for the same VCD (size + mtime), signal list and
+    max_samples it was written with.
+
+    Returns:
+        (raw samples memmap, metadata dict), or None on a cache miss
+    """
+    cache_path, meta_path = vcd_cache_paths(vcd_file)
+    if not (cache_path.exists() and meta_path.exists()):
+        return None
+
+    stat = Path(vcd_file).stat()
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if (meta.get('vcd_size') != stat.st_size or meta.get('vcd_mtime') != stat.st_mtime
+            or meta.get('signals_of_interest') != list(signals_of_interest)
+            or meta.get('max_samples') != max_samples):
+        return None
+
+    return np.load(cache_path, mmap_mode='r'), meta
+
+
+def decode_signal_rows(raw, names, bits, counts):
+    """
+    Trim raw sample rows, apply two's complement and downcast to the narrowest dtype.
+
+    Args:
+        raw: 2-D array (n_signals, capacity) of raw unsigned samples
+        names, bits, counts: Per-row signal name, width and valid sample count
+
+    Returns:
+        Dict of signal_name -> numpy array of values
+    """
+    result = {}
+    for row, (sig_name, width, count) in enumerate(zip(names, bits, counts)):
+        if count:
+            # Single-bit signals arrive as scalar 0/1 changes, never sign-extended
+            signed = sig_name not in UNSIGNED_SIGNALS and width > 1
+            values = twos_complement(raw[row, :count], width, signed=signed)
+            result[sig_name] = values.astype(signal_dtype(width, signed))
+            print(f"  {sig_name}: {count} samples, range [{values.min()}, {values.max()}]")
+    return result
+
+
+def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000, use_cache=True):
     """
     Lightweight VCD parser optimized for large files.
 
+    Raw samples are spilled to an on-disk memmap next to the VCD
+    (<vcd>.parse_cache.npy) instead of in-RAM buffers; re-runs on an
+    unchanged VCD load that cache and skip parsing entirely.
+
     Args:
         vcd_file: Path to VCD file
         signals_of_interest: List of signal names to extract
         max_samples: Maximum number of samples to extract
+        use_cache: Read/write the on-disk parse cache
 
     Returns:
         Dict of signal_name -> numpy array of values
     """
+    if use_cache:
+        cached = load_vcd_cache(vcd_file, signals_of_interest, max_samples)
+        if cached is not None:
+            raw, meta = cached
+            print(f"Loaded VCD parse cache: {vcd_cache_paths(vcd_file)[0]}")
+            return decode_signal_rows(raw, meta['names'], meta['bits'], meta['counts'])
+
     print(f"Parsing VCD file: {vcd_file}")
 
     # First pass: extract signal IDs from header
@@ -92,8 +170,32 @@ def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000):
 
     print(f"Found {len(signal_ids)} matching signals: {list(signal_ids.values())}")
 
-    # Second pass: extract values
-    signal_data = {sig: [] for sig in signals_of_interest if sig in signal_ids.values()}
+    # Second pass: extract values into one preallocated row per signal (SoA),
+    # backed by an on-disk memmap when caching. Raw unsigned values are stored
+    # as int32 (int64 for 32-bit integers); two's complement conversion is
+    # deferred and vectorized once parsing is done.
+    ids_per_signal = defaultdict(int)
+    for sig_name in signal_ids.values():
+        ids_per_signal[sig_name] += 1
+    signal_bits = {signal_ids[var_id]: width for var_id, width in signal_widths.items()}
+    names = list(ids_per_signal)
+    capacity = max_samples * max(ids_per_signal.values(), default=1)
+    raw_dtype = np.int64 if any(b > 31 for b in signal_bits.values()) else np.int32
+    raw = None
+    if use_cache:
+        cache_path, meta_path = vcd_cache_paths(vcd_file)
+        try:
+            meta_path.unlink(missing_ok=True)  # Metadata is written last, after a complete parse
+            raw = np.lib.format.open_memmap(cache_path, mode='w+', dtype=raw_dtype,
+                                            shape=(len(names), capacity))
+        except OSError as e:
+            # The cache is only an optimization (read-only or shared VCD directory)
+            print(f"Warning: not caching VCD parse ({e})")
+            use_cache = False
+    if raw is None:
+        raw = np.empty((len(names), capacity), dtype=raw_dtype)
+    signal_data = {sig: raw[row] for row, sig in enumerate(names)}
+    signal_counts = dict.fromkeys(signal_data, 0)
     current_time = 0
     sample_count = 0
     last_values = {}
@@ -111,7 +213,9 @@ def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000):
                 if sample_count % 10 == 0:  # Every 10th sample
                     for var_id, sig_name in signal_ids.items():
                         if var_id in last_values:
-                            signal_data[sig_name].append(last_values[var_id])
+                            n = signal_counts[sig_name]
+                            signal_data[sig_name][n] = last_values[var_id]
+                            signal_counts[sig_name] = n + 1
 
                 if sample_count >= max_samples * 10:
                     break
@@ -126,12 +230,7 @@ def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000):
 
                     if var_id in signal_ids:
                         try:
-                            val = int(bin_val, 2)
-                            width = signal_widths.get(var_id, 18)
-                            sig_name = signal_ids[var_id]
-                            signed = sig_name not in UNSIGNED_SIGNALS
-                            val = twos_complement(val, width, signed=signed)
-                            last_values[var_id] = val
+                            last_values[var_id] = int(bin_val, 2)
                         except ValueError:
                             pass
 
@@ -146,14 +245,23 @@ def parse_vcd_lightweight(vcd_file, signals_of_interest, max_samples=100000):
                     elif val_char == '0':
                         last_values[var_id] = 0
 
-    # Convert to numpy arrays
-    result = {}
-    for sig_name, values in signal_data.items():
-        if values:
-            result[sig_name] = np.array(values)
-            print(f"  {sig_name}: {len(values)} samples, range [{min(values)}, {max(values)}]")
+    bits = [signal_bits[sig] for sig in names]
+    counts = [signal_counts[sig] for sig in names]
 
-    return result
+    if use_cache:
+        raw.flush()
+        stat = Path(vcd_file).stat()
+        try:
+            with open(meta_path, 'w') as f:
+                json.dump({'vcd_size': stat.st_size, 'vcd_mtime': stat.st_mtime,
+                           'signals_of_interest': list(signals_of_interest),
+                           'max_samples': max_samples,
+                           'names': names, 'bits': bits, 'counts': counts}, f)
+            print(f"Wrote VCD parse cache: {cache_path}")
+        except OSError as e:
+            print(f"Warning: could not write VCD parse cache metadata ({e})")
+
+    return decode_signal_rows(raw, names, bits, counts)
 
 
 def parse_vcd_by_state(vcd_file, signals, samples_per_state=8000):
@@ -203,28 +311,33 @@ def parse_vcd_by_state(vcd_file, signals, samples_per_state=8000):
     return state_data
 
 
-def compute_peak_trough_ratio(theta_x, gamma_amp, peak_threshold=0.7, trough_threshold=0.3):
+def compute_peak_trough_ratio(theta_phase, gamma_amp, peak_threshold=0.7, trough_threshold=0.3):
     """
     Compute ratio of gamma amplitude at theta peak vs trough.
 
     Args:
-        theta_x: Theta oscillator x component (Q4.14 format)
+        theta_phase: Theta phase in radians (from arctan2(theta_y, theta_x))
         gamma_amp: Gamma amplitude (Q4.14 format)
+        peak_threshold: Theta level percentile (0-1) above which a sample is a peak
+        trough_threshold: Theta level percentile (0-1) below which a sample is a trough
 
     Returns:
         ratio > 1 indicates theta-gamma coupling
     """
-    if len(theta_x) == 0 or len(gamma_amp) == 0:
+    if len(theta_phase) == 0 or len(gamma_amp) == 0:
         return 1.0
 
-    # Normalize theta to [0, 1]
-    theta_min, theta_max = np.min(theta_x), np.max(theta_x)
-    theta_range = theta_max - theta_min if theta_max > theta_min else 1.0
-    theta_norm = (theta_x - theta_min) / theta_range
+    # Theta level falls monotonically with |phase|, so its upper/lower percentiles
+    # are the lower/upper percentiles of the phase distance from the peak (0).
+    # One O(N) partition finds both cut points without sorting or normalizing.
+    phase_dist = np.abs(theta_phase)
+    last = len(phase_dist) - 1
+    k_peak = int((1 - peak_threshold) * last)
+    k_trough = int((1 - trough_threshold) * last)
+    cuts = np.partition(phase_dist, [k_peak, k_trough])
 
-    # Get gamma amplitude at theta peaks and troughs
-    at_peak = gamma_amp[theta_norm > peak_threshold]
-    at_trough = gamma_amp[theta_norm < trough_threshold]
+    at_peak = gamma_amp[phase_dist <= cuts[k_peak]]
+    at_trough = gamma_amp[phase_dist >= cuts[k_trough]]
 
     if len(at_peak) == 0 or len(at_trough) == 0:
         return 1.0
@@ -238,12 +351,12 @@ def compute_peak_trough_ratio(theta_x, gamma_amp, peak_threshold=0.7, trough_thr
     return mean_at_peak / mean_at_trough
 
 
-def compute_pac_modulation_index(theta_x, theta_y, gamma_amp, n_bins=18):
+def compute_pac_modulation_index(theta_phase, gamma_amp, n_bins=18):
     """
     Compute Phase-Amplitude Coupling Modulation Index.
 
     Args:
-        theta_x, theta_y: Theta oscillator components
+        theta_phase: Theta phase in radians (from arctan2(theta_y, theta_x))
         gamma_amp: Gamma amplitude
         n_bins: Number of phase bins
 
@@ -252,12 +365,9 @@ def compute_pac_modulation_index(theta_x, theta_y, gamma_amp, n_bins=18):
         bin_centers: Phase bin centers
         mean_amp: Mean gamma amplitude in each phase bin
     """
-    if len(theta_x) == 0:
+    if len(theta_phase) == 0:
         return 0.0, np.zeros(n_bins), np.zeros(n_bins)
 
-    # Compute theta phase from x, y components
-    theta_phase = np.arctan2(theta_y, theta_x)
-
     bin_edges = np.linspace(-np.pi, np.pi, n_bins + 1)
     bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
 
@@ -313,24 +423,34 @@ def analyze_state_metrics(state_data):
     """
     metrics = {}
 
+    # Samples may be stored as int16; widen once so abs() cannot wrap at -32768
+    # and arctan2 yields float64 phase
+    state_data = {k: v.astype(np.promote_types(v.dtype, np.int32), copy=False)
+                  for k, v in state_data.items()}
+
     # Use gamma_amp_raw for coupling metrics (before suppression)
     # Fall back to gamma_amp if raw not available
     gamma_signal = 'gamma_amp_raw' if 'gamma_amp_raw' in state_data else 'gamma_amp'
 
+    # Theta phase is shared by both coupling metrics - compute arctan2 once
+    has_gamma = gamma_signal in state_data
+    theta_phase = None
+    if all(k in state_data for k in ['theta_x', 'theta_y']):
+        theta_phase = np.arctan2(state_data['theta_y'], state_data['theta_x'])
+
     # Theta-Gamma Peak-Trough Ratio
-    if 'theta_x' in state_data and gamma_signal in state_data:
+    if theta_phase is not None and has_gamma:
         metrics['peak_trough_ratio'] = compute_peak_trough_ratio(
-            state_data['theta_x'],
+            theta_phase,
             state_data[gamma_signal]
         )
     else:
         metrics['peak_trough_ratio'] = 1.0
 
     # PAC Modulation Index
-    if all(k in state_data for k in ['theta_x', 'theta_y']) and gamma_signal in state_data:
+    if theta_phase is not None and has_gamma:
         mi, bins, amps = compute_pac_modulation_index(
-            state_data['theta_x'],
-            state_data['theta_y'],
+            theta_phase,
             state_data[gamma_signal]
         )
         metrics['pac_mi'] = mi
@@ -401,10 +521,12 @@ def run_vcd_analysis(vcd_file):
 
     state_data = parse_vcd_by_state(vcd_file, signals)
 
-    results = {}
-    for state_name, data in state_data.items():
-        print(f"\nAnalyzing {state_name}...")
-        results[state_name] = analyze_state_metrics(data)
+    # States are independent and CPU-bound - compute their metrics in parallel
+    print(f"\nAnalyzing {', '.join(state_data)}...")
+    n_workers = max(1, min(len(state_data), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = dict(zip(state_data.keys(),
+                           executor.map(analyze_state_metrics, state_data.values())))
 
     # Print summary
     print("\n" + "="*80)
@@ -23,9 +23,11 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from scipy import signal
-from scipy.fft import fft, fftfreq
+from scipy.fft import irfft, rfftfreq, next_fast_len
 from pathlib import Path
 
+from analysis_common import fast_fft, njit, prange
+
 # Fixed-point scaling
 SCALE = 16384
 
@@ -37,9 +39,18 @@ W_BETA       = 328 / SCALE    # 0.02 - low beta
 W_GAMMA      = 164 / SCALE    # 0.01 - gamma
 W_PINK_NOISE = 15073 / SCALE  # 0.92 - 1/f background dominates
 
+# Oscillator channels feeding the DAC mixer, in mixer order
+DAC_CHANNELS = ['theta_x',       # Theta (5.89 Hz)
+                'motor_l6_x',    # Alpha (9.53 Hz)
+                'motor_l5a_x',   # Beta (15.42 Hz)
+                'motor_l23_x']   # Gamma (40.36 Hz)
+
 # Sampling rate
 FS = 1000  # Hz
 
+# Pink noise depends only on length and FS - cached here across invocations
+PINK_NOISE_CACHE_DIR = Path.home() / '.cache'
+
 # Expected phi^n frequencies
 PHI_FREQS = {
     'theta': 5.89,
@@ -56,61 +67,120 @@ PHI_FREQS = {
     'L2/3 gamma (fast)': 65.3,
 }
 
+# PHI_FREQS sorted by frequency, for binary-search nearest matching
+PHI_SORTED = sorted(PHI_FREQS.items(), key=lambda x: x[1])
+PHI_SORTED_FREQS = np.array([freq for _, freq in PHI_SORTED])
+
+def fast_percentiles(values, percentiles):
+    """Nearest-rank percentiles from one O(N) partial partition (no full sort)."""
+    flat = np.ravel(values)
+    kth = [min(int(p / 100 * flat.size), flat.size - 1) for p in percentiles]
+    part = np.partition(flat, kth)
+    return [part[k] for k in kth]
+
+def nearest_phi_freq(freq):
+    """(name, freq) of the expected phi^n frequency closest to freq."""
+    i = int(np.clip(np.searchsorted(PHI_SORTED_FREQS, freq), 1, len(PHI_SORTED_FREQS) - 1))
+    if freq - PHI_SORTED_FREQS[i - 1] <= PHI_SORTED_FREQS[i] - freq:
+        i -= 1
+    return PHI_SORTED[i]
+
+def top_k_indices(values, k):
+    """Indices of the k largest values, largest first (O(N) selection, sort only k)."""
+    k = min(k, len(values))
+    if k == 0:
+        return np.array([], dtype=int)
+    top = np.argpartition(values, -k)[-k:]
+    return top[np.argsort(values[top])[::-1]]
+
 def load_data(filepath):
     """Load oscillator data."""
     print(f"Loading {filepath}...")
     df = pd.read_csv(filepath)
 
     metadata = ['time_ms', 'state', 'theta_phase', 'beta_quiet', 'sr_amplification']
-    for col in df.columns:
-        if col not in metadata:
-            df[col] = df[col].astype(float) / SCALE
+    data_cols = [col for col in df.columns if col not in metadata]
+    block = df[data_cols].to_numpy(dtype=np.float32)
+    block *= np.float32(1.0 / SCALE)
+    df[data_cols] = block
 
     return df
 
 def generate_pink_noise(n_samples):
-    """Generate 1/f pink noise."""
-    # Use Voss-McCartney algorithm approximation
-    white = np.random.randn(n_samples)
-
-    # Apply 1/f filter
-    freqs = fftfreq(n_samples, 1/FS)
+    """Generate 1/f pink noise (memory-mapped from the on-disk cache if present)."""
+    cache_path = PINK_NOISE_CACHE_DIR / f'fpga_pink_{n_samples}_{FS}hz.f32.npy'
+    if cache_path.exists():
+        return np.load(cache_path, mmap_mode='r')
+
+    # Timmer-Koenig construction directly in the rfft half-spectrum:
+    # Gaussian real/imaginary parts with amplitude 1/sqrt(f)
+    freqs = rfftfreq(n_samples, 1/FS)
     freqs[0] = 1  # Avoid division by zero
+    scale = 1 / np.sqrt(freqs)
+
+    re = np.random.randn(len(freqs)) * scale
+    im = np.random.randn(len(freqs)) * scale
+    im[0] = 0  # DC is real
+    if n_samples % 2 == 0:
+        im[-1] = 0  # Nyquist is real
 
-    # 1/f spectrum
-    spectrum = fft(white)
-    pink_spectrum = spectrum / np.sqrt(np.abs(freqs))
-    pink = np.real(np.fft.ifft(pink_spectrum))
+    spectrum = (re + 1j * im).astype(np.complex64)
+    with fast_fft():
+        pink = irfft(spectrum, n=n_samples)
 
     # Normalize
-    pink = pink / (np.std(pink) * 3)  # ~[-1, 1]
+    pink = (pink / (np.std(pink) * 3)).astype(np.float32)  # ~[-1, 1]
 
-    return pink
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(cache_path, pink)
 
-def simulate_dac_output(df):
-    """Simulate DAC mixer output from oscillator data (v6.0 5-channel mixer)."""
-    n_samples = len(df)
+    return pink
 
-    # Get all 5 channels for realistic EEG spectrum
-    theta_x = df['theta_x'].values
-    motor_l6 = df['motor_l6_x'].values     # Alpha (9.53 Hz)
-    motor_l5a = df['motor_l5a_x'].values   # Beta (15.42 Hz)
-    motor_l23 = df['motor_l23_x'].values   # Gamma (40.36 Hz)
+def _mix_dac_numpy(theta, l6, l5a, l23, pink, out_mixed, out_dac):
+    """5-channel mix + 12-bit DAC quantization with NumPy temporaries."""
+    out_mixed[:] = (W_THETA * theta +
+                    W_ALPHA * l6 +
+                    W_BETA * l5a +
+                    W_GAMMA * l23 +
+                    W_PINK_NOISE * pink)
+    out_dac[:] = np.clip((out_mixed + 1.0) * 2048, 0, 4095)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _mix_dac(theta, l6, l5a, l23, pink, out_mixed, out_dac):
+        """Fused single-pass 5-channel mix + 12-bit DAC quantization."""
+        for i in prange(theta.size):
+            m = (W_THETA * theta[i] + W_ALPHA * l6[i] + W_BETA * l5a[i] +
+                 W_GAMMA * l23[i] + W_PINK_NOISE * pink[i])
+            out_mixed[i] = m
+            v = int((m + 1.0) * 2048)
+            out_dac[i] = 0 if v < 0 else (4095 if v > 4095 else v)
+else:
+    _mix_dac = _mix_dac_numpy
+
+def load_dac_channels(df):
+    """Extract the DAC mixer channels as one contiguous (4, N) float32 array."""
+    return np.ascontiguousarray(df[DAC_CHANNELS].to_numpy(dtype=np.float32).T)
+
+def simulate_dac_output(osc):
+    """Simulate DAC mixer output from oscillator data (v6.0 5-channel mixer).
+
+    Args:
+        osc: (4, N) float32 array of DAC_CHANNELS (see load_dac_channels)
+    """
+    n_samples = osc.shape[1]
+
+    # Get all 5 channels for realistic EEG spectrum (4 oscillators + pink noise)
+    theta_x, motor_l6, motor_l5a, motor_l23 = osc
 
     # Generate pink noise
     pink = generate_pink_noise(n_samples)
 
-    # Mix according to output_mixer.v v6.0 weights (5-channel)
-    mixed = (W_THETA * theta_x +
-             W_ALPHA * motor_l6 +
-             W_BETA * motor_l5a +
-             W_GAMMA * motor_l23 +
-             W_PINK_NOISE * pink)
-
-    # Simulate 12-bit DAC quantization
-    # Shift to positive range and scale to 12 bits
-    shifted = mixed + 1.0  # Assuming signal in [-1, 1]
-    dac_12bit = np.clip(shifted * 2048, 0, 4095).astype(int)
+    # Mix according to output_mixer.v v6.0 weights (5-channel) and simulate
+    # 12-bit DAC quantization: shift [-1, 1] to positive range, scale to 12 bits
+    mixed = np.empty(n_samples, dtype=np.float32)
+    dac_12bit = np.empty(n_samples, dtype=np.int16)
+    _mix_dac(theta_x, motor_l6, motor_l5a, motor_l23, pink, mixed, dac_12bit)
 
     return mixed, dac_12bit, pink
 
@@ -124,9 +194,10 @@ def create_dac_spectrogram(mixed, output_path):
     # Main spectrogram
     ax1 = fig.add_axes([0.1, 0.55, 0.75, 0.38])
 
-    # High resolution spectrogram
-    f, t, Sxx = signal.spectrogram(mixed, fs=FS, nperseg=2048,
-                                    noverlap=1920, scaling='density')
+    # High resolution spectrogram (multi-threaded FFTs at a fast length)
+    with fast_fft():
+        f, t, Sxx = signal.spectrogram(mixed, fs=FS, nperseg=next_fast_len(2048),
+                                        noverlap=1920, scaling='density')
 
     # Limit frequency range
     freq_mask = f <= 100
@@ -135,9 +206,12 @@ def create_dac_spectrogram(mixed, output_path):
 
     # Plot in dB
     Sxx_db = 10 * np.log10(Sxx + 1e-12)
+    vmin, vmax = fast_percentiles(Sxx_db, [5, 99])
 
-    im = ax1.pcolormesh(t, f, Sxx_db, shading='gouraud', cmap='inferno',
-                        vmin=np.percentile(Sxx_db, 5), vmax=np.percentile(Sxx_db, 99))
+    # Uniform (t, f) grid: imshow with bilinear resampling replaces gouraud shading
+    im = ax1.imshow(Sxx_db, origin='lower', aspect='auto', cmap='inferno',
+                    extent=[t[0], t[-1], f[0], f[-1]], interpolation='bilinear',
+                    vmin=vmin, vmax=vmax)
 
     # Add phi^n frequency markers
     colors = {'theta': 'white', 'SR': 'lime', 'L': 'cyan'}
@@ -161,7 +235,8 @@ def create_dac_spectrogram(mixed, output_path):
     ax2 = fig.add_axes([0.1, 0.32, 0.75, 0.18])
 
     # Compute Welch PSD
-    f_psd, psd = signal.welch(mixed, fs=FS, nperseg=4096, noverlap=3072)
+    with fast_fft():
+        f_psd, psd = signal.welch(mixed, fs=FS, nperseg=next_fast_len(4096), noverlap=3072)
     freq_mask = f_psd <= 100
 
     ax2.semilogy(f_psd[freq_mask], psd[freq_mask], 'b-', linewidth=1)
@@ -176,7 +251,7 @@ def create_dac_spectrogram(mixed, output_path):
     ax2.scatter(peak_freqs, peak_powers, c='red', s=50, zorder=5, marker='v')
 
     # Annotate top peaks
-    sorted_idx = np.argsort(peak_powers)[::-1][:10]
+    sorted_idx = top_k_indices(peak_powers, 10)
     for idx in sorted_idx:
         ax2.annotate(f'{peak_freqs[idx]:.1f}Hz',
                     xy=(peak_freqs[idx], peak_powers[idx]),
@@ -217,7 +292,8 @@ def analyze_frequency_content(mixed, output_path):
 
     # 1. Full spectrum comparison
     ax = axes[0, 0]
-    f_psd, psd = signal.welch(mixed, fs=FS, nperseg=4096)
+    with fast_fft():
+        f_psd, psd = signal.welch(mixed, fs=FS, nperseg=next_fast_len(4096))
     ax.semilogy(f_psd, psd, 'b-', linewidth=1, label='DAC Output PSD')
 
     # Mark expected frequencies
@@ -243,7 +319,7 @@ def analyze_frequency_content(mixed, output_path):
     peak_powers = psd[peaks]
 
     # Sort by power
-    sorted_idx = np.argsort(peak_powers)[::-1][:15]
+    sorted_idx = top_k_indices(peak_powers, 15)
 
     table_text = "DETECTED PEAKS (Top 15)\n"
     table_text += "=" * 50 + "\n"
@@ -255,7 +331,7 @@ def analyze_frequency_content(mixed, output_path):
         power = peak_powers[idx]
 
         # Find nearest expected frequency
-        nearest = min(PHI_FREQS.items(), key=lambda x: abs(x[1] - freq))
+        nearest = nearest_phi_freq(freq)
         error = freq - nearest[1]
 
         table_text += f"{rank:<6} {freq:<12.2f} {power:<15.2e} {nearest[0]} ({error:+.2f})\n"
@@ -269,6 +345,7 @@ def analyze_frequency_content(mixed, output_path):
 
     # Check for harmonics of fundamental frequencies
     fundamentals = [5.89, 7.6, 9.53]  # theta, SR f0, alpha
+    df_bin = f_psd[1] - f_psd[0]      # Welch bins are uniform from 0 Hz
 
     for fund in fundamentals:
         harmonics = [fund * n for n in range(1, 8) if fund * n <= 100]
@@ -276,7 +353,7 @@ def analyze_frequency_content(mixed, output_path):
         # Extract power at each harmonic
         harmonic_powers = []
         for h in harmonics:
-            idx = np.argmin(np.abs(f_psd - h))
+            idx = int(round(h / df_bin))
             harmonic_powers.append(psd[idx])
 
         ax.semilogy(range(1, len(harmonics)+1), harmonic_powers, 'o-',
@@ -291,23 +368,16 @@ def analyze_frequency_content(mixed, output_path):
     # 4. Time-frequency coherence
     ax = axes[1, 1]
 
-    # Compute short-time spectral centroid
-    window = 500  # 500 ms windows
+    # Compute short-time spectral centroid from one spectrogram
+    # (256-sample frames, 100 ms hop) instead of a Welch call per window
+    nperseg_seg = next_fast_len(256)
     hop = 100     # 100 ms hop
-    n_windows = (len(mixed) - window) // hop
-
-    centroids = []
-    times = []
-
-    for i in range(n_windows):
-        start = i * hop
-        segment = mixed[start:start+window]
-        f_seg, psd_seg = signal.welch(segment, fs=FS, nperseg=256)
+    with fast_fft():
+        f_seg, times, psd_seg = signal.spectrogram(mixed, fs=FS, nperseg=nperseg_seg,
+                                                   noverlap=nperseg_seg - hop)
 
-        # Spectral centroid
-        centroid = np.sum(f_seg * psd_seg) / np.sum(psd_seg)
-        centroids.append(centroid)
-        times.append((start + window/2) / FS)
+    # Spectral centroid per frame
+    centroids = (f_seg[:, None] * psd_seg).sum(axis=0) / psd_seg.sum(axis=0)
 
     ax.plot(times, centroids, 'b-', linewidth=1)
     ax.axhline(y=40.36, color='red', linestyle='--', label='L2/3 gamma (40.36 Hz)')
@@ -336,7 +406,8 @@ def create_3d_spectrogram(mixed, output_path):
     ax = fig.add_subplot(111, projection='3d')
 
     # Compute spectrogram
-    f, t, Sxx = signal.spectrogram(mixed, fs=FS, nperseg=1024, noverlap=900)
+    with fast_fft():
+        f, t, Sxx = signal.spectrogram(mixed, fs=FS, nperseg=next_fast_len(1024), noverlap=900)
 
     # Limit frequency range
     freq_mask = f <= 80
@@ -349,14 +420,14 @@ def create_3d_spectrogram(mixed, output_path):
     # Create mesh
     T, F = np.meshgrid(t, f)
 
-    # Plot surface
+    # Plot surface (rasterized: the mesh is drawn as one image, labels stay vector)
     surf = ax.plot_surface(T, F, Sxx_db, cmap='viridis',
-                           linewidth=0, antialiased=True, alpha=0.8)
+                           linewidth=0, antialiased=True, alpha=0.8, rasterized=True)
 
     # Add phi^n frequency planes
+    z_val, = fast_percentiles(Sxx_db, [50])
     for name, freq in [('theta', 5.89), ('L5a', 15.42), ('L2/3', 40.36)]:
         if freq <= 80:
-            z_val = np.percentile(Sxx_db, 50)
             ax.plot([0, t[-1]], [freq, freq], [z_val, z_val],
                    'r--', linewidth=2, label=f'{name} ({freq} Hz)')
 
@@ -389,7 +460,8 @@ def main():
 
     # Simulate DAC output
     print("Simulating DAC output mixer...")
-    mixed, dac_12bit, pink = simulate_dac_output(df)
+    osc = load_dac_channels(df)
+    mixed, dac_12bit, pink = simulate_dac_output(osc)
 
     print(f"DAC output range: [{mixed.min():.3f}, {mixed.max():.3f}]")
     print(f"12-bit DAC range: [{dac_12bit.min()}, {dac_12bit.max()}]")
@@ -419,7 +491,7 @@ def main():
     print("\nTop 10 detected frequencies:")
     for i, (freq, power) in enumerate(zip(peak_freqs[:10], peak_powers[:10]), 1):
         # Find nearest expected
-        nearest = min(PHI_FREQS.items(), key=lambda x: abs(x[1] - freq))
+        nearest = nearest_phi_freq(freq)
         error = freq - nearest[1]
         match = "MATCH" if abs(error) < 2 else ""
         print(f"  {i:2d}. {freq:6.2f} Hz  (nearest: {nearest[0]}, error: {error:+.2f} Hz) {match}")
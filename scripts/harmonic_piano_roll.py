@@ -15,8 +15,15 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from scipy import signal
+from scipy.fft import next_fast_len
 from pathlib import Path
 
+from analysis_common import fast_fft, decimate_minmax
+
+# Let Agg merge near-collinear segments of long line paths
+plt.rcParams['path.simplify'] = True
+plt.rcParams['path.simplify_threshold'] = 1.0
+
 # Fixed-point scaling
 SCALE = 16384
 
@@ -65,16 +72,19 @@ def load_data(filepath):
     df = pd.read_csv(filepath)
 
     metadata = ['time_ms', 'state', 'theta_phase', 'beta_quiet', 'sr_amplification']
-    for col in df.columns:
-        if col not in metadata:
-            df[col] = df[col].astype(float) / SCALE
+    data_cols = [col for col in df.columns if col not in metadata]
+    block = df[data_cols].to_numpy(dtype=np.float32)
+    block *= np.float32(1.0 / SCALE)
+    df[data_cols] = block
 
     return df
 
 def compute_spectrogram(signal_data, fs=1000, nperseg=512, noverlap=480):
-    """Compute spectrogram for a signal."""
-    f, t, Sxx = signal.spectrogram(signal_data, fs=fs, nperseg=nperseg,
-                                    noverlap=noverlap, scaling='density')
+    """Compute spectrogram for a signal, or a batch of signals along the last axis
+    (multi-threaded FFTs at a fast length)."""
+    with fast_fft():
+        f, t, Sxx = signal.spectrogram(signal_data, fs=fs, nperseg=next_fast_len(nperseg),
+                                        noverlap=noverlap, scaling='density', axis=-1)
     return f, t, Sxx
 
 def create_harmonic_piano_roll(df, output_path):
@@ -83,14 +93,11 @@ def create_harmonic_piano_roll(df, output_path):
     n_oscillators = len(OSCILLATORS)
     duration = len(df) / 1000  # seconds
 
-    # Compute spectrograms for all oscillators
+    # Compute spectrograms for all oscillators in one batched call
     print("Computing spectrograms...")
-    spectrograms = []
-    for osc in OSCILLATORS:
-        if osc['col'] in df.columns:
-            sig = df[osc['col']].values
-            f, t, Sxx = compute_spectrogram(sig)
-            spectrograms.append({'osc': osc, 'f': f, 't': t, 'Sxx': Sxx})
+    present = [osc for osc in OSCILLATORS if osc['col'] in df.columns]
+    sigs = df[[osc['col'] for osc in present]].to_numpy().T  # (n_osc, N)
+    f, time_bins, Sxx = compute_spectrogram(sigs)             # Sxx: (n_osc, n_f, n_t)
 
     # Create figure
     fig = plt.figure(figsize=(20, 14))
@@ -103,36 +110,22 @@ def create_harmonic_piano_roll(df, output_path):
     # X-axis: time
     # Color: power at the oscillator's target frequency band
 
-    time_bins = spectrograms[0]['t']
     n_time = len(time_bins)
 
-    # Extract power at each oscillator's expected frequency
-    piano_roll = np.zeros((n_oscillators, n_time))
-
-    for i, spec in enumerate(spectrograms):
-        osc = spec['osc']
-        target_freq = osc['freq']
-        f = spec['f']
-        Sxx = spec['Sxx']
+    # Extract power at each oscillator's expected frequency:
+    # sum power within the bandwidth around the target, or use the
+    # closest bin if the band holds none
+    bandwidth = 5  # Hz
+    targets = np.array([osc['freq'] for osc in present], dtype=f.dtype)[:, None]
+    band_masks = (f >= targets - bandwidth) & (f <= targets + bandwidth)  # (n_osc, n_f)
+    empty = ~band_masks.any(axis=1)
+    band_masks[empty, np.argmin(np.abs(f - targets[empty]), axis=1)] = True
 
-        # Find frequency bin closest to target
-        freq_idx = np.argmin(np.abs(f - target_freq))
-
-        # Also include neighboring bins for bandwidth
-        bandwidth = 5  # Hz
-        freq_mask = (f >= target_freq - bandwidth) & (f <= target_freq + bandwidth)
-
-        # Sum power in bandwidth
-        if np.any(freq_mask):
-            piano_roll[i, :] = np.sum(Sxx[freq_mask, :], axis=0)
-        else:
-            piano_roll[i, :] = Sxx[freq_idx, :]
+    piano_roll = np.zeros((n_oscillators, n_time), dtype=Sxx.dtype)
+    piano_roll[:len(present)] = np.einsum('of,oft->ot', band_masks.astype(Sxx.dtype), Sxx)
 
     # Normalize each row independently for better visibility
-    for i in range(n_oscillators):
-        row_max = np.max(piano_roll[i, :])
-        if row_max > 0:
-            piano_roll[i, :] = piano_roll[i, :] / row_max
+    piano_roll /= piano_roll.max(axis=1, keepdims=True) + 1e-12
 
     # Plot piano roll
     im = ax_main.imshow(piano_roll, aspect='auto', origin='lower',
@@ -205,9 +198,7 @@ def create_frequency_waterfall(df, output_path):
 
     # Compute spectrogram of combined signal (sum of all oscillators)
     oscillator_cols = [osc['col'] for osc in OSCILLATORS if osc['col'] in df.columns]
-    combined = np.zeros(len(df))
-    for col in oscillator_cols:
-        combined += df[col].values
+    combined = df[oscillator_cols].to_numpy(dtype=np.float32).sum(axis=1)
 
     f, t, Sxx = compute_spectrogram(combined, nperseg=1024, noverlap=960)
 
@@ -216,9 +207,11 @@ def create_frequency_waterfall(df, output_path):
     f = f[freq_mask]
     Sxx = Sxx[freq_mask, :]
 
-    # Plot spectrogram
-    im = ax.pcolormesh(t, f, 10 * np.log10(Sxx + 1e-10),
-                       shading='gouraud', cmap='viridis')
+    # Plot spectrogram (uniform grid: imshow with bilinear resampling
+    # replaces gouraud shading)
+    im = ax.imshow(10 * np.log10(Sxx + 1e-10), origin='lower', aspect='auto',
+                   extent=[t[0], t[-1], f[0], f[-1]], interpolation='bilinear',
+                   cmap='viridis')
 
     # Add phi^n frequency lines
     phi = 1.618033988749895
@@ -257,6 +250,7 @@ def create_amplitude_envelope_roll(df, output_path):
     """Create piano roll showing amplitude envelopes over time."""
 
     from scipy.signal import hilbert
+    from scipy.ndimage import uniform_filter1d
 
     fig, ax = plt.subplots(figsize=(18, 12))
 
@@ -264,30 +258,29 @@ def create_amplitude_envelope_roll(df, output_path):
     duration = len(df) / 1000
     time_s = df['time_ms'].values / 1000
 
-    # Compute and plot amplitude envelopes
-    for i, osc in enumerate(OSCILLATORS):
-        if osc['col'] not in df.columns:
-            continue
-
-        sig = df[osc['col']].values
-        sig_centered = sig - sig.mean()
-
-        # Compute amplitude envelope
-        analytic = hilbert(sig_centered)
-        amplitude = np.abs(analytic)
-
-        # Smooth the envelope
-        window = 50  # 50 ms smoothing
-        amplitude_smooth = np.convolve(amplitude, np.ones(window)/window, mode='same')
-
-        # Normalize
-        amp_norm = amplitude_smooth / (amplitude_smooth.max() + 1e-10)
-
-        # Plot as filled area offset by oscillator index
-        baseline = i
-        ax.fill_between(time_s, baseline, baseline + amp_norm * 0.8,
-                       alpha=0.7, color=osc['color'], linewidth=0)
-        ax.plot(time_s, baseline + amp_norm * 0.8,
+    # Compute amplitude envelopes for all oscillators in one batch
+    rows = [(i, osc) for i, osc in enumerate(OSCILLATORS) if osc['col'] in df.columns]
+    sigs = np.ascontiguousarray(df[[osc['col'] for _, osc in rows]].to_numpy(dtype=np.float32).T)  # (n_osc, N)
+    sigs -= sigs.mean(axis=1, keepdims=True)
+
+    with fast_fft():
+        amplitude = np.abs(hilbert(sigs, axis=-1))
+
+    # Smooth the envelopes (O(N) box filter; edges extend the nearest
+    # sample so the envelope does not taper toward zero at either end)
+    window = 50  # 50 ms smoothing
+    amplitude_smooth = uniform_filter1d(amplitude, window, axis=-1, mode='nearest')
+
+    # Normalize each row
+    amp_norm = amplitude_smooth / (amplitude_smooth.max(axis=1, keepdims=True) + 1e-10)
+
+    # Plot as filled areas offset by oscillator index, min/max-decimated so
+    # narrow amplitude peaks survive
+    for (baseline, osc), amp_full in zip(rows, amp_norm):
+        time_ds, amp = decimate_minmax(time_s, amp_full)
+        ax.fill_between(time_ds, baseline, baseline + amp * 0.8,
+                       alpha=0.7, color=osc['color'], linewidth=0, rasterized=True)
+        ax.plot(time_ds, baseline + amp * 0.8,
                color=osc['color'], linewidth=0.3, alpha=0.8)
 
     # Labels
@@ -14,8 +14,13 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
+import io
 import sys
 import os
+from pathlib import Path
+
+from analysis_common import (q14_to_float, rolling_transitions, decimate_minmax,
+                             column_arrays, dashboard_figure)
 
 # State names and colors
 STATE_NAMES = {
@@ -34,30 +39,39 @@ STATE_COLORS = {
     4: '#9C27B0',
 }
 
+# Integer columns read by the plots; anything else in the CSV is skipped
+CSV_COLUMNS = ['sample', 'state', 'theta_x', 'learning', 'recalling',
+               'pattern_in', 'phase_pattern', 'cortical', 'debug']
+
 def load_data(csv_path):
     """Load CSV data from simulation."""
-    df = pd.read_csv(csv_path)
+    # Nullable Int32 so a row truncated by an interrupted simulation parses
+    # (as NA) instead of raising; such rows are dropped before the int32 cast
+    df = pd.read_csv(csv_path, usecols=lambda c: c in CSV_COLUMNS,
+                     dtype={c: 'Int32' for c in CSV_COLUMNS}, on_bad_lines='skip')
+    df = df.dropna().astype(np.int32)
     # Convert fixed-point theta to float (Q4.14)
     if 'theta_x' in df.columns:
-        df['theta_x'] = df['theta_x'].astype(float) / 16384.0
+        df['theta_x'] = q14_to_float(df['theta_x'].to_numpy())
     return df
 
 def plot_theta_and_learning(df, ax):
     """Plot theta oscillation with learning/recall events."""
-    samples = df['sample'].values
-    theta = df['theta_x'].values
+    c = column_arrays(df, ['sample', 'theta_x', 'learning', 'recalling'])
+    samples = c['sample']
+    theta = c['theta_x']
 
-    # Plot theta
-    ax.plot(samples, theta, 'b-', linewidth=0.5, alpha=0.7, label='Theta')
+    # Plot theta (decimated; event markers below use the full arrays)
+    ax.plot(*decimate_minmax(samples, theta), 'b-', linewidth=0.5, alpha=0.7, label='Theta')
 
     # Mark learning events
-    learning_mask = df['learning'] == 1
+    learning_mask = c['learning'] == 1
     if learning_mask.any():
         ax.scatter(samples[learning_mask], theta[learning_mask],
                    c='green', s=30, marker='^', label='Learning', zorder=5)
 
     # Mark recall events
-    recall_mask = df['recalling'] == 1
+    recall_mask = c['recalling'] == 1
     if recall_mask.any():
         ax.scatter(samples[recall_mask], theta[recall_mask],
                    c='orange', s=30, marker='v', label='Recall', zorder=5)
@@ -73,10 +87,11 @@ def plot_theta_and_learning(df, ax):
 
 def plot_patterns(df, ax):
     """Plot pattern_in and phase_pattern over time."""
-    samples = df['sample'].values
+    c = column_arrays(df, ['sample', 'pattern_in', 'phase_pattern'])
+    samples = c['sample']
 
-    ax.step(samples, df['pattern_in'], 'g-', linewidth=1, where='post', label='Pattern In', alpha=0.8)
-    ax.step(samples, df['phase_pattern'], 'r-', linewidth=1, where='post', label='Phase Pattern Out', alpha=0.8)
+    ax.step(*decimate_minmax(samples, c['pattern_in']), 'g-', linewidth=1, where='post', label='Pattern In', alpha=0.8)
+    ax.step(*decimate_minmax(samples, c['phase_pattern']), 'r-', linewidth=1, where='post', label='Phase Pattern Out', alpha=0.8)
 
     ax.set_xlabel('Sample')
     ax.set_ylabel('Pattern (6-bit)')
@@ -87,19 +102,18 @@ def plot_patterns(df, ax):
 
 def plot_cortical_pattern(df, ax):
     """Plot cortical pattern (closed-loop feedback)."""
-    samples = df['sample'].values
+    c = column_arrays(df, ['sample', 'cortical'])
+    samples = c['sample']
+    cortical = c['cortical']
 
-    ax.step(samples, df['cortical'], 'purple', linewidth=0.8, where='post', label='Cortical Pattern')
+    ax.step(*decimate_minmax(samples, cortical), 'purple', linewidth=0.8, where='post', label='Cortical Pattern')
 
     # Count transitions
-    cortical = df['cortical'].values
-    transitions = np.zeros(len(cortical))
     window = 50
-    for i in range(window, len(cortical)):
-        transitions[i] = np.sum(np.diff(cortical[i-window:i]) != 0)
+    transitions = rolling_transitions(cortical, window)
 
     ax2 = ax.twinx()
-    ax2.plot(samples, transitions, 'orange', linewidth=1, alpha=0.6, label='Transitions/50')
+    ax2.plot(*decimate_minmax(samples, transitions), 'orange', linewidth=1, alpha=0.6, label='Transitions/50')
     ax2.set_ylabel('Transitions', color='orange')
     ax2.tick_params(axis='y', labelcolor='orange')
 
@@ -112,8 +126,9 @@ def plot_cortical_pattern(df, ax):
 
 def plot_learning_events_histogram(df, ax):
     """Histogram of learning events by theta phase."""
-    theta = df['theta_x'].values
-    learning = df['learning'].values
+    c = column_arrays(df, ['theta_x', 'learning'])
+    theta = c['theta_x']
+    learning = c['learning']
 
     # Get theta values where learning occurred
     learning_theta = theta[learning == 1]
@@ -130,19 +145,12 @@ def plot_learning_events_histogram(df, ax):
 
 def plot_state_comparison(df, ax):
     """Compare learning events across states."""
-    states = df['state'].unique()
-
-    learn_counts = []
-    recall_counts = []
-    state_labels = []
-    colors = []
+    # One grouped pass instead of a boolean mask per state
+    g = df.groupby('state', sort=True)[['learning', 'recalling']].sum()
 
-    for state in sorted(states):
-        state_df = df[df['state'] == state]
-        learn_counts.append(state_df['learning'].sum())
-        recall_counts.append(state_df['recalling'].sum())
-        state_labels.append(STATE_NAMES.get(state, f'S{state}'))
-        colors.append(STATE_COLORS.get(state, 'gray'))
+    learn_counts = g['learning'].to_numpy()
+    recall_counts = g['recalling'].to_numpy()
+    state_labels = [STATE_NAMES.get(state, f'S{state}') for state in g.index]
 
     x = np.arange(len(state_labels))
     width = 0.35
@@ -159,8 +167,9 @@ def plot_state_comparison(df, ax):
 
 def plot_ca3_debug(df, ax):
     """Plot CA3 state machine debug output."""
-    samples = df['sample'].values
-    debug = df['debug'].values
+    c = column_arrays(df, ['sample', 'debug'])
+    samples = c['sample']
+    debug = c['debug']
 
     ax.step(samples, debug, 'k-', linewidth=0.8, where='post')
 
@@ -174,65 +183,77 @@ def plot_ca3_debug(df, ax):
     ax.set_title('CA3 State Machine Transitions')
     ax.grid(True, alpha=0.3)
 
-def main():
-    # Find CSV file
-    if len(sys.argv) > 1:
-        csv_path = sys.argv[1]
-    else:
-        candidates = ['learning_test.csv', 'fpga/learning_test.csv']
-        csv_path = None
-        for c in candidates:
-            if os.path.exists(c):
-                csv_path = c
-                break
-        if csv_path is None:
-            print("Error: learning_test.csv not found")
-            print("Run the simulation first: vvp tb_learning_fast.vvp")
-            sys.exit(1)
+def dashboard_layout(fig):
+    """Axes for the 3x2 dashboard layout."""
+    gs = fig.add_gridspec(3, 2, hspace=0.35, wspace=0.25)
+    return [fig.add_subplot(gs[0, :]), fig.add_subplot(gs[1, 0]), fig.add_subplot(gs[1, 1]),
+            fig.add_subplot(gs[2, 0]), fig.add_subplot(gs[2, 1])]
+
+def build_fig(fig=None):
+    """Return (fig, axes) for the dashboard, reusing the open figure when possible."""
+    return dashboard_figure(dashboard_layout, fig)
 
+def render(csv_path, fig=None):
+    """Load csv_path and draw the full dashboard; returns the figure."""
     print(f"Loading data from: {csv_path}")
     df = load_data(csv_path)
     print(f"Loaded {len(df)} samples")
     print(f"Learning events: {df['learning'].sum()}")
     print(f"Recall events: {df['recalling'].sum()}")
 
-    # Create figure
-    fig = plt.figure(figsize=(14, 12))
+    fig, (ax1, ax2, ax3, ax4, ax5) = build_fig(fig)
     fig.suptitle('CA3 Hebbian Learning Analysis\nφⁿ Neural Processor (Full Closed-Loop)',
                  fontsize=14, fontweight='bold')
 
-    gs = fig.add_gridspec(3, 2, hspace=0.35, wspace=0.25)
-
     # Plot 1: Theta with learning/recall markers
-    ax1 = fig.add_subplot(gs[0, :])
     plot_theta_and_learning(df, ax1)
 
     # Plot 2: CA3 input/output patterns
-    ax2 = fig.add_subplot(gs[1, 0])
     plot_patterns(df, ax2)
 
     # Plot 3: Cortical pattern (closed-loop)
-    ax3 = fig.add_subplot(gs[1, 1])
     plot_cortical_pattern(df, ax3)
 
     # Plot 4: Learning events histogram
-    ax4 = fig.add_subplot(gs[2, 0])
     plot_learning_events_histogram(df, ax4)
 
     # Plot 5: CA3 state machine
-    ax5 = fig.add_subplot(gs[2, 1])
     plot_ca3_debug(df, ax5)
 
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
+    fig.tight_layout(rect=[0, 0, 1, 0.96])
+    return fig
+
+def main():
+    # Find CSV file
+    if len(sys.argv) > 1:
+        csv_path = sys.argv[1]
+    else:
+        candidates = ['learning_test.csv', 'fpga/learning_test.csv']
+        csv_path = None
+        for c in candidates:
+            if os.path.exists(c):
+                csv_path = c
+                break
+        if csv_path is None:
+            print("Error: learning_test.csv not found")
+            print("Run the simulation first: vvp tb_learning_fast.vvp")
+            sys.exit(1)
+
+    fig = render(csv_path)
+
+    # Render the PNG once; every destination gets the same bytes
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+    png = buf.getvalue()
 
     # Save figure
     output_path = csv_path.replace('.csv', '.png')
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
+    Path(output_path).write_bytes(png)
     print(f"Saved visualization to: {output_path}")
 
     os.makedirs('fpga/exports', exist_ok=True)
     alt_path = 'fpga/exports/learning_test.png'
-    plt.savefig(alt_path, dpi=150, bbox_inches='tight')
+    Path(alt_path).write_bytes(png)
     print(f"Also saved to: {alt_path}")
 
     plt.show()
@@ -14,8 +14,15 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.colors import to_rgb
+import io
 import sys
 import os
+from pathlib import Path
+
+from analysis_common import (q14_to_float, rolling_transitions, rolling_mean,
+                             decimate_minmax, column_arrays, dashboard_figure)
 
 # State names and colors
 STATE_NAMES = {
@@ -34,46 +41,63 @@ STATE_COLORS = {
     4: '#9C27B0',   # Purple - Meditation
 }
 
+# Columns written by tb_state_transitions.v; all are integers in the CSV
+CSV_COLUMNS = ['sample', 'state', 'theta_x', 'theta_amp', 'gamma_x', 'alpha_x', 'pattern']
+Q14_COLUMNS = ['theta_x', 'theta_amp', 'gamma_x', 'alpha_x']
+
 def load_data(csv_path):
     """Load CSV data from simulation."""
-    df = pd.read_csv(csv_path)
-    # Convert fixed-point to float (Q4.14 format)
-    for col in ['theta_x', 'theta_amp', 'gamma_x', 'alpha_x']:
-        if col in df.columns:
-            df[col] = df[col].astype(float) / 16384.0  # 2^14
+    # Nullable Int32 so a row truncated by an interrupted simulation parses
+    # (as NA) instead of raising; such rows are dropped before the int32 cast
+    df = pd.read_csv(csv_path, usecols=lambda c: c in CSV_COLUMNS,
+                     dtype={c: 'Int32' for c in CSV_COLUMNS}, on_bad_lines='skip')
+    df = df.dropna().astype(np.int32)
+    # Convert fixed-point to float32 (Q4.14 format) in one block
+    cols = [c for c in Q14_COLUMNS if c in df.columns]
+    df[cols] = q14_to_float(df[cols].to_numpy())
     return df
 
 def detect_state_changes(df):
-    """Find indices where state changes."""
-    state_changes = []
-    prev_state = df['state'].iloc[0]
-    for i, state in enumerate(df['state']):
-        if state != prev_state:
-            state_changes.append((i, prev_state, state))
-            prev_state = state
-    return state_changes
+    """Find state segments.
+
+    Returns (boundaries, state_values): segment k spans
+    boundaries[k]:boundaries[k+1] in state state_values[k].
+    """
+    states = df['state'].to_numpy()
+    idx = np.flatnonzero(np.diff(states)) + 1
+    boundaries = np.concatenate([[0], idx, [len(states)]])
+    return boundaries, states[boundaries[:-1]]
+
+def _blend(color, alpha):
+    """Color as it appears at the given alpha over a white background."""
+    return tuple(1 - alpha * (1 - c) for c in to_rgb(color))
+
+def _draw_state_bg(ax, samples, boundaries, state_values):
+    """Shade each state segment as one PolyCollection (full axes height)."""
+    if len(state_values) == 1:
+        # Single-state slice (e.g. the detail view): tint the axes instead
+        ax.set_facecolor(_blend(STATE_COLORS[state_values[0]], 0.2))
+        return
+    x0 = samples[boundaries[:-1]]
+    x1 = samples[np.minimum(boundaries[1:], len(samples) - 1)]
+    verts = [[(a, 0), (a, 1), (b, 1), (b, 0)] for a, b in zip(x0, x1)]
+    ax.add_collection(PolyCollection(verts, facecolors=[STATE_COLORS[st] for st in state_values],
+                                     edgecolors='none', alpha=0.2,
+                                     transform=ax.get_xaxis_transform()),
+                      autolim=False)
 
 def plot_oscillator_dynamics(df, ax, title):
     """Plot theta and gamma oscillator waveforms with state background."""
-    samples = df['sample'].values
-
-    # Plot state background colors
-    state_changes = detect_state_changes(df)
-    prev_idx = 0
-    prev_state = df['state'].iloc[0]
-
-    for i, (idx, from_state, to_state) in enumerate(state_changes):
-        ax.axvspan(samples[prev_idx], samples[idx],
-                   alpha=0.2, color=STATE_COLORS[prev_state], label=None)
-        prev_idx = idx
-        prev_state = to_state
-    # Fill last segment
-    ax.axvspan(samples[prev_idx], samples[-1],
-               alpha=0.2, color=STATE_COLORS[prev_state], label=None)
+    c = column_arrays(df, ['sample', 'theta_x', 'gamma_x'])
+    samples = c['sample']
+
+    # Plot state background colors (last segment runs to the final sample)
+    boundaries, state_values = detect_state_changes(df)
+    _draw_state_bg(ax, samples, boundaries, state_values)
 
     # Plot waveforms
-    ax.plot(samples, df['theta_x'], 'b-', alpha=0.7, linewidth=0.5, label='Theta (5.89 Hz)')
-    ax.plot(samples, df['gamma_x'], 'r-', alpha=0.7, linewidth=0.5, label='Gamma (40 Hz)')
+    ax.plot(*decimate_minmax(samples, c['theta_x']), 'b-', alpha=0.7, linewidth=0.5, label='Theta (5.89 Hz)')
+    ax.plot(*decimate_minmax(samples, c['gamma_x']), 'r-', alpha=0.7, linewidth=0.5, label='Gamma (40 Hz)')
 
     ax.set_xlabel('Sample')
     ax.set_ylabel('Amplitude')
@@ -81,43 +105,43 @@ def plot_oscillator_dynamics(df, ax, title):
     ax.legend(loc='upper right', fontsize=8)
     ax.grid(True, alpha=0.3)
 
-def plot_amplitudes(df, ax, title):
+def precompute_amplitudes(df, window=20):
+    """Smoothed amplitude envelopes and state segments, shared by every panel drawing them."""
+    # Calculate running amplitude (absolute value), one row per oscillator
+    amps = np.abs(df[['theta_x', 'gamma_x', 'alpha_x']].to_numpy().T)
+    boundaries, state_values = detect_state_changes(df)
+    return {
+        'samples': df['sample'].to_numpy(),
+        'smooth': rolling_mean(amps, window),  # Smooth with rolling window
+        'boundaries': boundaries,
+        'state_values': state_values,
+    }
+
+def plot_amplitudes(prep, ax, title):
     """Plot amplitude envelopes with state transitions marked."""
-    samples = df['sample'].values
-
-    # Calculate running amplitude (absolute value)
-    theta_amp = np.abs(df['theta_x'].values)
-    gamma_amp = np.abs(df['gamma_x'].values)
-    alpha_amp = np.abs(df['alpha_x'].values)
-
-    # Smooth with rolling window
-    window = 20
-    theta_smooth = pd.Series(theta_amp).rolling(window, min_periods=1).mean()
-    gamma_smooth = pd.Series(gamma_amp).rolling(window, min_periods=1).mean()
-    alpha_smooth = pd.Series(alpha_amp).rolling(window, min_periods=1).mean()
+    samples = prep['samples']
+    theta_smooth, gamma_smooth, alpha_smooth = prep['smooth']
+    boundaries, state_values = prep['boundaries'], prep['state_values']
 
     # Plot state background
-    state_changes = detect_state_changes(df)
-    prev_idx = 0
-    prev_state = df['state'].iloc[0]
-
-    for idx, from_state, to_state in state_changes:
-        ax.axvspan(samples[prev_idx], samples[idx],
-                   alpha=0.2, color=STATE_COLORS[prev_state])
-        prev_idx = idx
-        prev_state = to_state
-    ax.axvspan(samples[prev_idx], samples[-1], alpha=0.2, color=STATE_COLORS[prev_state])
+    _draw_state_bg(ax, samples, boundaries, state_values)
 
     # Plot amplitudes
-    ax.plot(samples, theta_smooth, 'b-', linewidth=1.5, label='Theta Amp')
-    ax.plot(samples, gamma_smooth, 'r-', linewidth=1.5, label='Gamma Amp')
-    ax.plot(samples, alpha_smooth, 'g-', linewidth=1.5, label='Alpha Amp')
+    ax.plot(*decimate_minmax(samples, theta_smooth), 'b-', linewidth=1.5, label='Theta Amp')
+    ax.plot(*decimate_minmax(samples, gamma_smooth), 'r-', linewidth=1.5, label='Gamma Amp')
+    ax.plot(*decimate_minmax(samples, alpha_smooth), 'g-', linewidth=1.5, label='Alpha Amp')
 
     # Mark state transitions
-    for idx, from_state, to_state in state_changes:
-        ax.axvline(samples[idx], color='black', linestyle='--', alpha=0.5, linewidth=0.8)
-        ax.text(samples[idx], ax.get_ylim()[1]*0.95,
-                f'{STATE_NAMES[to_state]}',
+    xs = samples[boundaries[1:-1]]
+    if len(xs):
+        ax.add_collection(LineCollection([[(x, 0), (x, 1)] for x in xs], colors='black',
+                                         linestyles='--', alpha=0.5, linewidths=0.8,
+                                         transform=ax.get_xaxis_transform()),
+                          autolim=False)
+    # Label height read once; get_ylim() forces an autoscale pass per call
+    label_y = ax.get_ylim()[1] * 0.95
+    for x, to_state in zip(xs, state_values[1:]):
+        ax.text(x, label_y, STATE_NAMES[to_state],
                 rotation=90, va='top', ha='right', fontsize=7)
 
     ax.set_xlabel('Sample')
@@ -128,23 +152,18 @@ def plot_amplitudes(df, ax, title):
 
 def plot_state_comparison(df, ax):
     """Bar chart comparing mean amplitudes per state."""
-    states = df['state'].unique()
-    states = sorted(states)
-
-    theta_means = []
-    gamma_means = []
-    alpha_means = []
-    state_labels = []
-    colors = []
-
-    for state in states:
-        state_df = df[df['state'] == state]
-        if len(state_df) > 100:  # Only include states with enough samples
-            theta_means.append(np.abs(state_df['theta_x']).mean())
-            gamma_means.append(np.abs(state_df['gamma_x']).mean())
-            alpha_means.append(np.abs(state_df['alpha_x']).mean())
-            state_labels.append(STATE_NAMES.get(state, f'State {state}'))
-            colors.append(STATE_COLORS.get(state, 'gray'))
+    # One grouped pass over |x| instead of a boolean mask per state
+    g = df.assign(theta_abs=df['theta_x'].abs(),
+                  gamma_abs=df['gamma_x'].abs(),
+                  alpha_abs=df['alpha_x'].abs()).groupby('state', sort=True).agg(
+        theta=('theta_abs', 'mean'), gamma=('gamma_abs', 'mean'),
+        alpha=('alpha_abs', 'mean'), n=('state', 'size'))
+    g = g[g['n'] > 100]  # Only include states with enough samples
+
+    theta_means = g['theta'].to_numpy()
+    gamma_means = g['gamma'].to_numpy()
+    alpha_means = g['alpha'].to_numpy()
+    state_labels = [STATE_NAMES.get(state, f'State {state}') for state in g.index]
 
     x = np.arange(len(state_labels))
     width = 0.25
@@ -160,34 +179,28 @@ def plot_state_comparison(df, ax):
     ax.legend(loc='upper right', fontsize=8)
     ax.grid(True, alpha=0.3, axis='y')
 
-def plot_pattern_dynamics(df, ax):
-    """Plot cortical pattern changes over time."""
-    samples = df['sample'].values
-    patterns = df['pattern'].values
+def plot_pattern_dynamics(df, ax, segments=None):
+    """Plot cortical pattern changes over time.
 
-    # Plot state background
-    state_changes = detect_state_changes(df)
-    prev_idx = 0
-    prev_state = df['state'].iloc[0]
+    segments: optional precomputed (boundaries, state_values) for df.
+    """
+    c = column_arrays(df, ['sample', 'pattern'])
+    samples = c['sample']
+    patterns = c['pattern']
 
-    for idx, from_state, to_state in state_changes:
-        ax.axvspan(samples[prev_idx], samples[idx],
-                   alpha=0.2, color=STATE_COLORS[prev_state])
-        prev_idx = idx
-        prev_state = to_state
-    ax.axvspan(samples[prev_idx], samples[-1], alpha=0.2, color=STATE_COLORS[prev_state])
+    # Plot state background
+    boundaries, state_values = segments if segments is not None else detect_state_changes(df)
+    _draw_state_bg(ax, samples, boundaries, state_values)
 
     # Plot pattern as step function
-    ax.step(samples, patterns, 'k-', linewidth=0.8, where='post')
+    ax.step(*decimate_minmax(samples, patterns), 'k-', linewidth=0.8, where='post')
 
     # Count transitions in sliding window
     window = 50
-    transitions = np.zeros(len(patterns))
-    for i in range(window, len(patterns)):
-        transitions[i] = np.sum(np.diff(patterns[i-window:i]) != 0)
+    transitions = rolling_transitions(patterns, window)
 
     ax2 = ax.twinx()
-    ax2.plot(samples, transitions, 'orange', linewidth=1, alpha=0.7, label='Transitions/window')
+    ax2.plot(*decimate_minmax(samples, transitions), 'orange', linewidth=1, alpha=0.7, label='Transitions/window')
     ax2.set_ylabel('Transitions (window=50)', color='orange')
     ax2.tick_params(axis='y', labelcolor='orange')
 
@@ -204,74 +217,88 @@ def create_legend_patches():
         patches.append(Patch(facecolor=STATE_COLORS[state], alpha=0.5, label=name))
     return patches
 
-def main():
-    # Find CSV file
-    if len(sys.argv) > 1:
-        csv_path = sys.argv[1]
-    else:
-        # Try common locations
-        candidates = ['state_transitions.csv', 'fpga/state_transitions.csv']
-        csv_path = None
-        for c in candidates:
-            if os.path.exists(c):
-                csv_path = c
-                break
-        if csv_path is None:
-            print("Error: state_transitions.csv not found")
-            print("Run the simulation first: vvp tb_state_transitions.vvp")
-            sys.exit(1)
+def dashboard_layout(fig):
+    """Axes for the 3x2 dashboard layout."""
+    gs = fig.add_gridspec(3, 2, hspace=0.35, wspace=0.25)
+    return [fig.add_subplot(gs[0, 0]), fig.add_subplot(gs[0, 1]), fig.add_subplot(gs[1, :]),
+            fig.add_subplot(gs[2, 0]), fig.add_subplot(gs[2, 1])]
+
+def build_fig(fig=None):
+    """Return (fig, axes) for the dashboard, reusing the open figure when possible."""
+    return dashboard_figure(dashboard_layout, fig)
 
+def render(csv_path, fig=None):
+    """Load csv_path and draw the full dashboard; returns the figure."""
     print(f"Loading data from: {csv_path}")
     df = load_data(csv_path)
     print(f"Loaded {len(df)} samples")
 
-    # Create figure with subplots
-    fig = plt.figure(figsize=(14, 12))
+    fig, (ax1, ax2, ax3, ax4, ax5) = build_fig(fig)
     fig.suptitle('State Transition & Hysteresis Analysis\nφⁿ Neural Processor v6.1',
                  fontsize=14, fontweight='bold')
 
-    # Create grid layout
-    gs = fig.add_gridspec(3, 2, hspace=0.35, wspace=0.25)
-
     # Plot 1: Oscillator waveforms (top left)
-    ax1 = fig.add_subplot(gs[0, 0])
     # Show first 2000 samples for detail
     df_detail = df.head(200)
     plot_oscillator_dynamics(df_detail, ax1, 'Oscillator Waveforms (Detail)')
 
+    # Envelopes and state segments are computed once for plots 2, 3 and 5
+    prep = precompute_amplitudes(df)
+
     # Plot 2: Amplitude envelopes (top right)
-    ax2 = fig.add_subplot(gs[0, 1])
-    plot_amplitudes(df, ax2, 'Amplitude Envelopes with State Transitions')
+    plot_amplitudes(prep, ax2, 'Amplitude Envelopes with State Transitions')
 
     # Plot 3: Full waveforms (middle, spans both columns)
-    ax3 = fig.add_subplot(gs[1, :])
-    plot_amplitudes(df, ax3, 'Complete Test Session - Oscillator Dynamics')
+    plot_amplitudes(prep, ax3, 'Complete Test Session - Oscillator Dynamics')
 
     # Plot 4: State comparison (bottom left)
-    ax4 = fig.add_subplot(gs[2, 0])
     plot_state_comparison(df, ax4)
 
     # Plot 5: Pattern dynamics (bottom right)
-    ax5 = fig.add_subplot(gs[2, 1])
-    plot_pattern_dynamics(df, ax5)
+    plot_pattern_dynamics(df, ax5, (prep['boundaries'], prep['state_values']))
 
     # Add state legend
     patches = create_legend_patches()
     fig.legend(handles=patches, loc='upper center', ncol=5,
                bbox_to_anchor=(0.5, 0.98), fontsize=9)
 
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
+    fig.tight_layout(rect=[0, 0, 1, 0.96])
+    return fig
+
+def main():
+    # Find CSV file
+    if len(sys.argv) > 1:
+        csv_path = sys.argv[1]
+    else:
+        # Try common locations
+        candidates = ['state_transitions.csv', 'fpga/state_transitions.csv']
+        csv_path = None
+        for c in candidates:
+            if os.path.exists(c):
+                csv_path = c
+                break
+        if csv_path is None:
+            print("Error: state_transitions.csv not found")
+            print("Run the simulation first: vvp tb_state_transitions.vvp")
+            sys.exit(1)
+
+    fig = render(csv_path)
+
+    # Render the PNG once; every destination gets the same bytes
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+    png = buf.getvalue()
 
     # Save figure
     output_path = csv_path.replace('.csv', '.png')
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
+    Path(output_path).write_bytes(png)
     print(f"Saved visualization to: {output_path}")
 
     # Also save to standard location
     if not output_path.startswith('fpga/'):
         os.makedirs('fpga/exports', exist_ok=True)
         alt_path = 'fpga/exports/state_transitions.png'
-        plt.savefig(alt_path, dpi=150, bbox_inches='tight')
+        Path(alt_path).write_bytes(png)
         print(f"Also saved to: {alt_path}")
 
     plt.show()
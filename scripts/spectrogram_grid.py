@@ -1,59 +1,71 @@
 #!/usr/bin/env python3
 """
 Generate 2x2 grid of spectrograms from multiple seed runs.
-Usage: python3 scripts/spectrogram_grid.py
+Usage: python3 scripts/spectrogram_grid.py [--final]
+
+Previews are saved at QUICK_DPI; --final renders at FINAL_DPI.
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from scipy import signal
 import os
+import sys
+
+from analysis_common import load_dac, highpass_sos
+
+QUICK_DPI = 100  # Preview renders
+FINAL_DPI = 150  # Publication renders (--final)
+
+# STFT window, built once (scipy.signal.spectrogram's default Tukey(0.25))
+NPERSEG = 2048
+STFT_WINDOW = signal.get_window(('tukey', 0.25), NPERSEG)
 
 def compute_spectrogram(dac_data, fs=1000):
-    """Compute spectrogram from DAC output data."""
+    """Compute spectrogram from DAC output data.
+
+    Accepts a single trace or a (seeds, N) stack; a stack is filtered and
+    transformed in one batched call along the last axis.
+    """
     # High-pass filter at 3 Hz to remove ultra-low frequency dominance
-    sos = signal.butter(4, 3, btype='high', fs=fs, output='sos')
-    dac_filtered = signal.sosfilt(sos, dac_data)
+    dac_filtered = signal.sosfilt(highpass_sos(fs), dac_data, axis=-1)
 
     # Center the data
-    dac_centered = dac_filtered - np.mean(dac_filtered)
+    dac_centered = dac_filtered - np.mean(dac_filtered, axis=-1, keepdims=True)
 
     # Spectrogram parameters
-    nperseg = 2048  # ~2s window at 1kHz
+    nperseg = NPERSEG  # ~2s window at 1kHz
     noverlap = nperseg * 3 // 4  # 75% overlap
 
-    f, t, Sxx = signal.spectrogram(dac_centered, fs=fs, nperseg=nperseg,
-                                    noverlap=noverlap, scaling='density')
+    # Data is already centered, so skip SciPy's per-segment detrend
+    f, t, Sxx = signal.spectrogram(dac_centered, fs=fs, window=STFT_WINDOW,
+                                    noverlap=noverlap, detrend=False,
+                                    scaling='density', axis=-1)
 
-    # Convert to dB
-    Sxx_db = 10 * np.log10(Sxx + 1e-10)
+    # Convert to dB (float32 halves the display-path bandwidth)
+    Sxx_db = (10 * np.log10(Sxx + 1e-10)).astype(np.float32)
 
     return f, t, Sxx_db
 
-def plot_spectrogram(ax, csv_file, seed_num, vmin=None, vmax=None):
-    """Plot spectrogram on given axis."""
-    # Load data
-    df = pd.read_csv(csv_file)
-    dac_data = df['dac_output'].values
-    duration = len(dac_data) / 1000  # seconds
-
-    # Compute spectrogram
-    f, t, Sxx_db = compute_spectrogram(dac_data)
+def plot_spectrogram(ax, f, t, Sxx_db, duration, title, vmin=None, vmax=None):
+    """Plot a precomputed spectrogram on given axis.
 
+    f/Sxx_db should already be sliced to the band of interest; imshow draws
+    exactly that range.
+    """
     # Auto-scale color range if not provided
     if vmin is None:
         vmin = np.percentile(Sxx_db, 5)
     if vmax is None:
         vmax = np.percentile(Sxx_db, 95)
 
-    # Plot with jet colormap for better contrast
-    im = ax.pcolormesh(t, f, Sxx_db, shading='gouraud', cmap='jet',
-                       vmin=vmin, vmax=vmax)
-    ax.set_ylim(4, 50)  # Focus on neural bands (4-50 Hz)
+    # Plot with jet colormap for better contrast (regular grid -> raster image)
+    im = ax.imshow(Sxx_db, aspect='auto', origin='lower', cmap='jet',
+                   extent=[t[0], t[-1], f[0], f[-1]], interpolation='bilinear',
+                   vmin=vmin, vmax=vmax, rasterized=True)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Frequency (Hz)')
-    ax.set_title(f'Seed {seed_num} ({duration:.0f}s)')
+    ax.set_title(title, fontsize=11)
 
     # Add phase boundaries
     phase_duration = duration / 5
@@ -65,7 +77,7 @@ def plot_spectrogram(ax, csv_file, seed_num, vmin=None, vmax=None):
     ax.axhline(y=13, color='white', linestyle=':', alpha=0.3)  # alpha/beta
     ax.axhline(y=30, color='white', linestyle=':', alpha=0.3)  # beta/gamma
 
-    return im
+    return im, phase_duration
 
 def main():
     # Find seed files
@@ -81,18 +93,24 @@ def main():
 
     # First pass: compute common color scale and gather statistics
     print("Computing spectrograms and statistics...")
+    traces = [load_dac(fname, on_bad_lines='skip')  # Skip malformed lines
+              for _, fname in seed_files]
+    if len({len(x) for x in traces}) == 1:
+        # Equal-length runs: filter and transform all seeds in one batch
+        f, t, Sxx_stack = compute_spectrogram(np.stack(traces))
+        results = [(f, t, Sxx_db) for Sxx_db in Sxx_stack]
+    else:
+        results = [compute_spectrogram(x) for x in traces]
+
     all_db = []
     spectrograms = []
     stats = []
-    for seed, fname in seed_files:
-        df = pd.read_csv(fname, on_bad_lines='skip')  # Skip malformed lines
-        dac_data = df['dac_output'].values
-        f, t, Sxx_db = compute_spectrogram(dac_data)
+    for (seed, fname), dac_data, (f, t, Sxx_db) in zip(seed_files, traces, results):
         # Only include 4-50 Hz for color scale
         freq_mask = (f >= 4) & (f <= 50)
         band_data = Sxx_db[freq_mask, :]
         all_db.append(band_data)
-        spectrograms.append((f, t, Sxx_db, dac_data))
+        spectrograms.append((f[freq_mask], t, band_data, dac_data))  # Focus on neural bands
         # Statistics for this seed
         stats.append({
             'seed': seed,
@@ -104,9 +122,16 @@ def main():
         print(f"  Seed {seed}: DAC mean={stats[-1]['dac_mean']:.1f}, std={stats[-1]['dac_std']:.1f}, "
               f"Band mean={stats[-1]['band_mean']:.1f} dB, std={stats[-1]['band_std']:.1f} dB")
 
-    all_db_flat = np.concatenate([s.flatten() for s in all_db])
-    vmin = np.percentile(all_db_flat, 2)
-    vmax = np.percentile(all_db_flat, 98)
+    # Nearest-rank 2nd/98th percentiles: pack all bands into one buffer and
+    # partially partition it in place instead of concatenating and sorting
+    buf = np.empty(sum(s.size for s in all_db), dtype=np.float32)
+    o = 0
+    for s in all_db:
+        buf[o:o + s.size] = s.ravel()
+        o += s.size
+    k2, k98 = int(0.02 * buf.size), min(int(0.98 * buf.size), buf.size - 1)
+    buf.partition([k2, k98])
+    vmin, vmax = buf[k2], buf[k98]
     print(f"Common color scale: {vmin:.1f} to {vmax:.1f} dB")
 
     # Create figure with GridSpec for proper colorbar placement
@@ -125,26 +150,11 @@ def main():
         f, t, Sxx_db, dac_data = spectrograms[idx]
         duration = len(dac_data) / 1000
 
-        # Plot spectrogram
-        im = ax.pcolormesh(t, f, Sxx_db, shading='gouraud', cmap='jet',
-                           vmin=vmin, vmax=vmax)
-        ax.set_ylim(4, 50)
-        ax.set_xlabel('Time (s)')
-        ax.set_ylabel('Frequency (Hz)')
-
-        # Title with statistics
+        # Plot spectrogram with statistics in the title
         s = stats[idx]
-        ax.set_title(f'Seed {seed} (σ={s["dac_std"]:.0f})', fontsize=11)
-
-        # Add phase boundaries
-        phase_duration = duration / 5
-        for i in range(1, 5):
-            ax.axvline(x=i * phase_duration, color='white', linestyle='--', alpha=0.5)
-
-        # Add band labels
-        ax.axhline(y=8, color='white', linestyle=':', alpha=0.3)
-        ax.axhline(y=13, color='white', linestyle=':', alpha=0.3)
-        ax.axhline(y=30, color='white', linestyle=':', alpha=0.3)
+        im, phase_duration = plot_spectrogram(ax, f, t, Sxx_db, duration,
+                                              f'Seed {seed} (σ={s["dac_std"]:.0f})',
+                                              vmin=vmin, vmax=vmax)
 
         # Add phase labels at top
         if row == 0:
@@ -158,7 +168,8 @@ def main():
     # Save
     os.makedirs('eeg_analysis', exist_ok=True)
     output_file = 'eeg_analysis/spectrogram_grid_4seeds.png'
-    plt.savefig(output_file, dpi=150, bbox_inches='tight')
+    dpi = FINAL_DPI if '--final' in sys.argv[1:] else QUICK_DPI
+    plt.savefig(output_file, dpi=dpi, bbox_inches='tight')
     print(f"\nSaved: {output_file}")
 
     plt.close()
@@ -1,27 +1,77 @@
 #!/usr/bin/env python3
 """
 Show variance between seeds and time-series differences.
-Usage: python3 scripts/spectrogram_variance.py
+Usage: python3 scripts/spectrogram_variance.py [--final]
+
+Previews are saved at QUICK_DPI; --final renders at FINAL_DPI.
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from scipy import signal
 import os
+import sys
+
+from analysis_common import load_dac, highpass_sos, njit, prange
+
+QUICK_DPI = 100  # Preview renders
+FINAL_DPI = 150  # Publication renders (--final)
+
+# STFT window, built once (scipy.signal.spectrogram's default Tukey(0.25))
+NPERSEG = 2048
+STFT_WINDOW = signal.get_window(('tukey', 0.25), NPERSEG)
 
 def compute_spectrogram(dac_data, fs=1000):
-    """Compute spectrogram from DAC output data."""
-    sos = signal.butter(4, 3, btype='high', fs=fs, output='sos')
-    dac_filtered = signal.sosfilt(sos, dac_data)
-    dac_centered = dac_filtered - np.mean(dac_filtered)
-    nperseg = 2048
-    noverlap = nperseg * 3 // 4
-    f, t, Sxx = signal.spectrogram(dac_centered, fs=fs, nperseg=nperseg,
-                                    noverlap=noverlap, scaling='density')
+    """Compute spectrogram from DAC output data (1-D trace or (seeds, N) stack)."""
+    dac_filtered = signal.sosfilt(highpass_sos(fs), dac_data, axis=-1)
+    dac_centered = dac_filtered - np.mean(dac_filtered, axis=-1, keepdims=True)
+    noverlap = NPERSEG * 3 // 4
+    f, t, Sxx = signal.spectrogram(dac_centered, fs=fs, window=STFT_WINDOW,
+                                    noverlap=noverlap, detrend=False,
+                                    scaling='density', axis=-1)
     Sxx_db = 10 * np.log10(Sxx + 1e-10)
     return f, t, Sxx_db
 
+def _per_seed_stats_numpy(ts_stack, spec_band):
+    """Seed-to-seed correlation matrix and per-seed mean power spectrum."""
+    return np.corrcoef(ts_stack), spec_band.mean(axis=2)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def per_seed_stats(ts_stack, spec_band):
+        """Correlation (centered dot products) and time-averaged power in one pass per seed."""
+        n_seeds, n = ts_stack.shape
+        centered = np.empty((n_seeds, n))
+        for s in prange(n_seeds):
+            mu = 0.0
+            for k in range(n):
+                mu += ts_stack[s, k]
+            mu /= n
+            for k in range(n):
+                centered[s, k] = ts_stack[s, k] - mu
+        cov = np.empty((n_seeds, n_seeds))
+        for i in prange(n_seeds):
+            for j in range(n_seeds):
+                acc = 0.0
+                for k in range(n):
+                    acc += centered[i, k] * centered[j, k]
+                cov[i, j] = acc
+        corr = np.empty((n_seeds, n_seeds))
+        for i in range(n_seeds):
+            for j in range(n_seeds):
+                corr[i, j] = cov[i, j] / np.sqrt(cov[i, i] * cov[j, j])
+        n_freq, n_time = spec_band.shape[1], spec_band.shape[2]
+        mean_power = np.empty((n_seeds, n_freq))
+        for s in prange(n_seeds):
+            for fi in range(n_freq):
+                acc = 0.0
+                for ti in range(n_time):
+                    acc += spec_band[s, fi, ti]
+                mean_power[s, fi] = acc / n_time
+        return corr, mean_power
+else:
+    per_seed_stats = _per_seed_stats_numpy
+
 def main():
     # Load all seed files
     seed_files = []
@@ -34,37 +84,35 @@ def main():
         print(f"Error: Need 4 seed files, found {len(seed_files)}")
         return
 
-    # Compute all spectrograms
-    spectrograms = []
-    time_series = []
-    for seed, fname in seed_files:
-        df = pd.read_csv(fname)
-        dac_data = df['dac_output'].values
-        f, t, Sxx_db = compute_spectrogram(dac_data)
-        spectrograms.append(Sxx_db)
-        time_series.append(dac_data)
-
-    # Stack spectrograms (shape: [4, freq, time])
-    spec_stack = np.stack(spectrograms)
+    # Compute all spectrograms in one batched pass (shape: [4, freq, time])
+    time_series = np.stack([load_dac(fname) for _, fname in seed_files])
+    f, t, spec_stack = compute_spectrogram(time_series)
     freq_mask = (f >= 4) & (f <= 50)
+    spec_band = np.ascontiguousarray(spec_stack[:, freq_mask, :])
 
     # Compute mean and variance across seeds
-    spec_mean = np.mean(spec_stack[:, freq_mask, :], axis=0)
-    spec_std = np.std(spec_stack[:, freq_mask, :], axis=0)
+    spec_mean = np.mean(spec_band, axis=0)
+    spec_std = np.std(spec_band, axis=0)
     f_neural = f[freq_mask]
 
+    # Seed correlation and per-seed average power spectrum, outside the plotting code
+    corr_matrix, mean_powers = per_seed_stats(time_series, spec_band)
+
     # Create figure
     fig = plt.figure(figsize=(16, 12))
 
     # Row 1: Mean spectrogram and variance
     ax1 = fig.add_subplot(3, 2, 1)
-    im1 = ax1.pcolormesh(t, f_neural, spec_mean, shading='gouraud', cmap='jet')
+    extent = [t[0], t[-1], f_neural[0], f_neural[-1]]
+    im1 = ax1.imshow(spec_mean, aspect='auto', origin='lower', extent=extent,
+                     cmap='jet', interpolation='bilinear', rasterized=True)
     ax1.set_ylabel('Frequency (Hz)')
     ax1.set_title('Mean Spectrogram Across 4 Seeds')
     plt.colorbar(im1, ax=ax1, label='Power (dB)')
 
     ax2 = fig.add_subplot(3, 2, 2)
-    im2 = ax2.pcolormesh(t, f_neural, spec_std, shading='gouraud', cmap='hot')
+    im2 = ax2.imshow(spec_std, aspect='auto', origin='lower', extent=extent,
+                     cmap='hot', interpolation='bilinear', rasterized=True)
     ax2.set_ylabel('Frequency (Hz)')
     ax2.set_title('Standard Deviation Across Seeds (Where They Differ)')
     plt.colorbar(im2, ax=ax2, label='Std Dev (dB)')
@@ -94,8 +142,6 @@ def main():
 
     # Row 3: Correlation matrix between seeds
     ax5 = fig.add_subplot(3, 2, 5)
-    # Compute correlation of time series
-    corr_matrix = np.corrcoef([ts for ts in time_series])
     im5 = ax5.imshow(corr_matrix, cmap='RdYlGn', vmin=-1, vmax=1)
     ax5.set_xticks(range(4))
     ax5.set_yticks(range(4))
@@ -112,9 +158,7 @@ def main():
     ax6 = fig.add_subplot(3, 2, 6)
     # Average power spectrum for each seed
     for i, (seed, _) in enumerate(seed_files):
-        # Average power over time for this seed
-        mean_power = np.mean(spectrograms[i][freq_mask, :], axis=1)
-        ax6.plot(f_neural, mean_power, color=colors[i], label=f'Seed {seed}', lw=1.5)
+        ax6.plot(f_neural, mean_powers[i], color=colors[i], label=f'Seed {seed}', lw=1.5)
     ax6.set_xlabel('Frequency (Hz)')
     ax6.set_ylabel('Mean Power (dB)')
     ax6.set_title('Average Power Spectrum per Seed')
@@ -126,7 +170,8 @@ def main():
     # Save
     os.makedirs('eeg_analysis', exist_ok=True)
     output_file = 'eeg_analysis/spectrogram_variance_analysis.png'
-    plt.savefig(output_file, dpi=150, bbox_inches='tight')
+    dpi = FINAL_DPI if '--final' in sys.argv[1:] else QUICK_DPI
+    plt.savefig(output_file, dpi=dpi, bbox_inches='tight')
     print(f"Saved: {output_file}")
 
     # Print summary
@@ -12,15 +12,51 @@ Usage:
 """
 
 import numpy as np
-import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Headless: these scripts only write PNGs
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 from scipy import signal
-from scipy.fft import fft, fftfreq
+from scipy.fft import set_workers
 import os
 
+from analysis_common import (cupy, cusignal, load_columns, dac_to_float, to_db,
+                             minmax_envelope, band_slice, band_powers_db,
+                             draw_phase_lines, draw_band_lines, db_colorbar)
+
 # Sampling rate
 FS = 1000  # Hz
 
+# Recording timeline: five 20 s phases
+PHASE_TIMES = [0, 20, 40, 60, 80, 100]
+PHASE_NAMES = ['NORMAL', 'N→M', 'MEDITATION', 'M→N', 'NORMAL']
+PHASE_COLORS = ['#00ff00', '#ffff00', '#0080ff', '#ffff00', '#00ff00']
+PHASE_DATA = {
+    'NORMAL (0-20s)': (0, 20000),
+    'N→M Transition': (20000, 40000),
+    'MEDITATION': (40000, 60000),
+    'M→N Transition': (60000, 80000),
+    'NORMAL (80-100s)': (80000, 100000),
+}
+
+# EEG bands
+BANDS = {
+    'Delta (1-4 Hz)': (1, 4),
+    'Theta (4-8 Hz)': (4, 8),
+    'Alpha (8-13 Hz)': (8, 13),
+    'Beta (13-30 Hz)': (13, 30),
+    'Gamma (30-80 Hz)': (30, 80),
+}
+BAND_COLORS = ['purple', 'blue', 'green', 'orange', 'red']
+
+# Spectrogram parameters; the Hamming window is built once
+NPERSEG = 4096
+NOVERLAP = 3584
+STFT_WINDOW = signal.get_window('hamming', NPERSEG)
+
+# Full-recording waveform is drawn as a min/max envelope of this many buckets
+ENVELOPE_BUCKETS = 2000
+
 # Expected phi^n frequencies
 PHI_FREQS = {
     'theta': 5.89,
@@ -37,57 +73,65 @@ PHI_FREQS = {
     'L2/3 gamma (fast)': 65.3,
 }
 
-def main():
-    # Load data
-    csv_path = 'state_transition_dac.csv'
-    if not os.path.exists(csv_path):
-        print(f"ERROR: {csv_path} not found!")
-        return
-
-    print(f"Loading {csv_path}...")
-    df = pd.read_csv(csv_path)
-    print(f"  Loaded {len(df)} samples ({len(df)/1000:.1f} seconds at 1 kHz)")
-
-    # Extract DAC output (already mixed by Verilog)
-    dac_raw = df['dac_output'].values
-    phases = df['phase'].values
-    mu_values = df['mu_l5b'].values
-
-    # Convert 12-bit DAC to float [-1, 1]
-    dac_float = (dac_raw.astype(float) - 2048) / 2048
-
-    n_samples = len(dac_float)
-    time_axis = np.arange(n_samples) / FS
-
-    # Create output directory
-    os.makedirs('eeg_analysis', exist_ok=True)
-
-    #=========================================================================
-    # Figure 1: Time-Domain Waveform
-    #=========================================================================
+def compute_spectrogram(dac_float, fs=FS):
+    """Single STFT pass shared by every figure: (f, t, Sxx)."""
+    if cusignal is not None:
+        # cuFFT batch; copied back so the plots stay NumPy
+        f, t, Sxx = cusignal.spectrogram(cupy.asarray(dac_float), fs,
+                                         window=cupy.asarray(STFT_WINDOW),
+                                         noverlap=NOVERLAP)
+        f, t, Sxx = cupy.asnumpy(f), cupy.asnumpy(t), cupy.asnumpy(Sxx)
+    else:
+        # FFT batch spread over all cores
+        with set_workers(-1):
+            f, t, Sxx = signal.spectrogram(dac_float, fs,
+                                            window=STFT_WINDOW,
+                                            noverlap=NOVERLAP)
+    return f, t, Sxx
+
+def compute_phase_psds(dac_float):
+    """Welch PSD per phase, keyed by phase name.
+
+    Equal-length phases go through one batched call (one window, one FFT batch).
+    """
+    segments = [dac_float[start:end] for start, end in PHASE_DATA.values()]
+    if cusignal is not None and len({len(seg) for seg in segments}) == 1:
+        f_psd, psd_batch = cusignal.welch(cupy.asarray(np.stack(segments)), FS,
+                                          nperseg=2048, axis=-1)
+        f_psd, psd_batch = cupy.asnumpy(f_psd), cupy.asnumpy(psd_batch)
+        return {name: (f_psd, psd) for name, psd in zip(PHASE_DATA, psd_batch)}
+    with set_workers(-1):
+        if len({len(seg) for seg in segments}) == 1:
+            f_psd, psd_batch = signal.welch(np.stack(segments), FS, nperseg=2048, axis=-1)
+            return {name: (f_psd, psd) for name, psd in zip(PHASE_DATA, psd_batch)}
+        return {name: signal.welch(seg, FS, nperseg=2048)
+                for name, seg in zip(PHASE_DATA, segments)}
+
+def plot_waveform(dac_float, time_axis):
+    """Figure 1: Time-domain waveform with zoomed NORMAL/MEDITATION panels."""
     print("Generating time-domain waveform...")
     fig1, axes1 = plt.subplots(3, 1, figsize=(14, 10))
 
     # Full waveform
     ax = axes1[0]
-    ax.plot(time_axis, dac_float, 'b-', linewidth=0.3, alpha=0.7)
+    # Min/max envelope: ~2000 buckets cover the figure's pixel width
+    env_t, env_lo, env_hi = minmax_envelope(dac_float, FS, ENVELOPE_BUCKETS)
+    ax.fill_between(env_t, env_lo, env_hi, color='b', linewidth=0, alpha=0.7)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Amplitude')
     ax.set_title('DAC Output - Full 100 Second Recording')
     ax.set_xlim(0, 100)
 
-    # Phase boundaries
-    phase_times = [0, 20, 40, 60, 80, 100]
-    phase_names = ['NORMAL', 'N→M', 'MEDITATION', 'M→N', 'NORMAL']
-    for i, t in enumerate(phase_times[:-1]):
-        ax.axvline(t, color='red', linestyle='--', alpha=0.5)
-        ax.text(t + 10, ax.get_ylim()[1] * 0.9, phase_names[i],
-                ha='center', fontsize=10, color='red')
+    # Phase boundaries; label height read once (get_ylim forces an autoscale pass)
+    draw_phase_lines(ax, PHASE_TIMES[:-1], colors='red', linestyles='--', alpha=0.5)
+    label_y = ax.get_ylim()[1] * 0.9
+    for t, name in zip(PHASE_TIMES[:-1], PHASE_NAMES):
+        ax.text(t + 10, label_y, name, ha='center', fontsize=10, color='red')
 
     # Zoomed NORMAL section (0-5s)
     ax = axes1[1]
-    mask = time_axis < 5
-    ax.plot(time_axis[mask], dac_float[mask], 'b-', linewidth=0.5)
+    zoom = slice(0, 5 * FS)  # Integer sample range: views, no mask scan
+    ax.plot(time_axis[zoom], dac_float[zoom], 'b-', linewidth=0.5)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Amplitude')
     ax.set_title('NORMAL State Detail (0-5s)')
@@ -95,38 +139,31 @@ def main():
 
     # Zoomed MEDITATION section (45-50s)
     ax = axes1[2]
-    mask = (time_axis >= 45) & (time_axis < 50)
-    ax.plot(time_axis[mask], dac_float[mask], 'g-', linewidth=0.5)
+    zoom = slice(45 * FS, 50 * FS)
+    ax.plot(time_axis[zoom], dac_float[zoom], 'g-', linewidth=0.5)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Amplitude')
     ax.set_title('MEDITATION State Detail (45-50s)')
     ax.set_xlim(45, 50)
 
     plt.tight_layout()
-    plt.savefig('eeg_analysis/state_transition_waveform.png', dpi=150)
+    fig1.savefig('eeg_analysis/state_transition_waveform.png', dpi=150)
+    plt.close(fig1)
     print("  Saved: eeg_analysis/state_transition_waveform.png")
 
-    #=========================================================================
-    # Figure 2: Spectrogram with Phase Annotations
-    #=========================================================================
+def plot_spectrogram(spec):
+    """Figure 2: Spectrogram with phase annotations."""
     print("Generating spectrogram...")
+    f, t, Sxx = spec
     fig2, ax = plt.subplots(figsize=(14, 6))
 
-    # Compute spectrogram
-    nperseg = 4096
-    noverlap = 3584
-    f, t, Sxx = signal.spectrogram(dac_float, FS,
-                                    nperseg=nperseg,
-                                    noverlap=noverlap,
-                                    window='hamming')
-
-    # Limit to 0-80 Hz
-    freq_mask = f <= 80
-    power_db = 10 * np.log10(Sxx[freq_mask, :] + 1e-12)
-
-    im = ax.pcolormesh(t, f[freq_mask], power_db,
-                       shading='gouraud', cmap='viridis',
-                       vmin=-60, vmax=-20)
+    # Limit to 0-80 Hz (a row view; the log scale is applied by the norm, -60..-20 dB)
+    rows = band_slice(f, 0, 80)
+    f_plot = f[rows]
+    im = ax.imshow(Sxx[rows], aspect='auto', origin='lower',
+                   extent=[t[0], t[-1], f_plot[0], f_plot[-1]],
+                   interpolation='bilinear', cmap='viridis',
+                   norm=LogNorm(vmin=1e-6, vmax=1e-2), rasterized=True)
 
     # Add phi^n frequency markers
     for name, freq in PHI_FREQS.items():
@@ -134,14 +171,12 @@ def main():
             ax.axhline(freq, color='white', linestyle='--', alpha=0.4, linewidth=0.8)
 
     # Phase boundaries
-    phase_colors = ['#00ff00', '#ffff00', '#0080ff', '#ffff00', '#00ff00']
-    for i, (start, end) in enumerate(zip(phase_times[:-1], phase_times[1:])):
-        if i > 0:
-            ax.axvline(start, color='red', linestyle='-', alpha=0.6, linewidth=2)
+    draw_phase_lines(ax, PHASE_TIMES[1:-1], colors='red', alpha=0.6, linewidths=2)
+    for i, (start, end) in enumerate(zip(PHASE_TIMES[:-1], PHASE_TIMES[1:])):
         mid = (start + end) / 2
-        ax.text(mid, 75, phase_names[i], ha='center', va='top',
+        ax.text(mid, 75, PHASE_NAMES[i], ha='center', va='top',
                 fontsize=11, color='white', fontweight='bold',
-                bbox=dict(boxstyle='round,pad=0.3', facecolor=phase_colors[i],
+                bbox=dict(boxstyle='round,pad=0.3', facecolor=PHASE_COLORS[i],
                          alpha=0.5, edgecolor='none'))
 
     ax.set_xlabel('Time (s)', fontsize=12)
@@ -150,38 +185,24 @@ def main():
     ax.set_xlim(0, 100)
     ax.set_ylim(0, 80)
 
-    plt.colorbar(im, ax=ax, label='Power (dB)')
+    db_colorbar(im, ax)
     plt.tight_layout()
-    plt.savefig('eeg_analysis/state_transition_dac_spectrogram.png', dpi=150)
+    fig2.savefig('eeg_analysis/state_transition_dac_spectrogram.png', dpi=150)
+    plt.close(fig2)
     print("  Saved: eeg_analysis/state_transition_dac_spectrogram.png")
 
-    #=========================================================================
-    # Figure 3: Power Spectral Density Comparison
-    #=========================================================================
-    print("Computing PSDs for each phase...")
+def plot_psd_comparison(psd_cache):
+    """Figure 3: Per-phase PSDs plus a NORMAL/N→M/MEDITATION overlay."""
     fig3, axes3 = plt.subplots(2, 3, figsize=(15, 10))
 
-    phase_data = {
-        'NORMAL (0-20s)': (0, 20000),
-        'N→M Transition': (20000, 40000),
-        'MEDITATION': (40000, 60000),
-        'M→N Transition': (60000, 80000),
-        'NORMAL (80-100s)': (80000, 100000),
-    }
-
     colors = ['green', 'orange', 'blue', 'orange', 'green']
 
-    for idx, ((name, (start, end)), color) in enumerate(zip(phase_data.items(), colors)):
+    for idx, ((name, (f_psd, psd)), color) in enumerate(zip(psd_cache.items(), colors)):
         row, col = divmod(idx, 3)
         ax = axes3[row, col] if idx < 5 else None
         if ax is None:
             continue
 
-        segment = dac_float[start:end]
-
-        # Welch PSD
-        f_psd, psd = signal.welch(segment, FS, nperseg=2048)
-
         # Limit to 0-80 Hz
         mask = f_psd <= 80
         ax.semilogy(f_psd[mask], psd[mask], color=color, linewidth=1.5)
@@ -199,9 +220,7 @@ def main():
 
     # 6th subplot: overlay comparison
     ax = axes3[1, 2]
-    for (name, (start, end)), color in zip(list(phase_data.items())[:3], ['green', 'orange', 'blue']):
-        segment = dac_float[start:end]
-        f_psd, psd = signal.welch(segment, FS, nperseg=2048)
+    for (name, (f_psd, psd)), color in zip(list(psd_cache.items())[:3], ['green', 'orange', 'blue']):
         mask = f_psd <= 80
         label = name.split()[0]  # First word
         ax.semilogy(f_psd[mask], psd[mask], color=color, linewidth=1.5, alpha=0.8, label=label)
@@ -214,42 +233,35 @@ def main():
     ax.grid(True, alpha=0.3)
 
     plt.tight_layout()
-    plt.savefig('eeg_analysis/state_transition_psd_comparison.png', dpi=150)
+    fig3.savefig('eeg_analysis/state_transition_psd_comparison.png', dpi=150)
+    plt.close(fig3)
     print("  Saved: eeg_analysis/state_transition_psd_comparison.png")
 
-    #=========================================================================
-    # Figure 4: Band Power Timeline
-    #=========================================================================
+def plot_band_timeline(spec, time_axis, mu_values):
+    """Figure 4: Band power over time (from the shared spectrogram) and the MU timeline."""
     print("Computing band power timeline...")
+    f, t, Sxx = spec
     fig4, axes4 = plt.subplots(2, 1, figsize=(14, 8))
 
-    # Define EEG bands
-    bands = {
-        'Delta (1-4 Hz)': (1, 4),
-        'Theta (4-8 Hz)': (4, 8),
-        'Alpha (8-13 Hz)': (8, 13),
-        'Beta (13-30 Hz)': (13, 30),
-        'Gamma (30-80 Hz)': (30, 80),
-    }
+    # Band row ranges on the spectrogram axis (f is monotonic, so each band is contiguous)
+    band_slices = [band_slice(f, low, high) for low, high in BANDS.values()]
+    lo = np.array([sl.start for sl in band_slices])
+    hi = np.array([sl.stop for sl in band_slices])
 
-    band_colors = ['purple', 'blue', 'green', 'orange', 'red']
+    # Band power over time in dB, shape (bands, times)
+    band_db = band_powers_db(Sxx, lo, hi, 1e-12)
 
-    # Compute band power over time
     ax = axes4[0]
-    for (band_name, (low, high)), color in zip(bands.items(), band_colors):
-        band_mask = (f >= low) & (f <= high)
-        band_power = 10 * np.log10(np.mean(Sxx[band_mask, :], axis=0) + 1e-12)
-        ax.plot(t, band_power, color=color, linewidth=1.5, label=band_name, alpha=0.8)
+    band_handles = draw_band_lines(ax, t, band_db, BAND_COLORS, list(BANDS))
 
     # Phase boundaries
-    for i, pt in enumerate(phase_times[1:-1]):
-        ax.axvline(pt, color='gray', linestyle='--', alpha=0.5)
+    draw_phase_lines(ax, PHASE_TIMES[1:-1], colors='gray', linestyles='--', alpha=0.5)
 
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Band Power (dB)')
     ax.set_title('EEG Band Power Over Time During State Transitions')
     ax.set_xlim(0, 100)
-    ax.legend(loc='upper right')
+    ax.legend(handles=band_handles, loc='upper right')
     ax.grid(True, alpha=0.3)
 
     # MU value timeline
@@ -268,37 +280,74 @@ def main():
     ax.grid(True, alpha=0.3)
 
     plt.tight_layout()
-    plt.savefig('eeg_analysis/state_transition_band_timeline.png', dpi=150)
+    fig4.savefig('eeg_analysis/state_transition_band_timeline.png', dpi=150)
+    plt.close(fig4)
     print("  Saved: eeg_analysis/state_transition_band_timeline.png")
 
-    #=========================================================================
-    # Summary Statistics
-    #=========================================================================
+def print_summary(dac_raw, psd_cache):
+    """Recording stats and the band-power-by-phase table."""
     print("\n" + "="*70)
     print("STATE TRANSITION ANALYSIS SUMMARY")
     print("="*70)
 
-    print(f"\nRecording: {n_samples/FS:.1f} seconds at {FS} Hz")
+    print(f"\nRecording: {len(dac_raw)/FS:.1f} seconds at {FS} Hz")
     print(f"DAC range: [{dac_raw.min()}, {dac_raw.max()}] (12-bit)")
 
     print("\nBand Power by Phase (dB):")
     print("-" * 70)
     header = f"{'Phase':<20}"
-    for band_name in bands.keys():
+    for band_name in BANDS.keys():
         header += f" {band_name.split()[0]:<10}"
     print(header)
     print("-" * 70)
 
-    for name, (start, end) in phase_data.items():
-        segment = dac_float[start:end]
-        f_psd, psd = signal.welch(segment, FS, nperseg=2048)
+    # Whole (phase x band) table at once: all phases share the Welch frequency
+    # axis, so band sums are differences of one cumulative sum per phase
+    f_psd = next(iter(psd_cache.values()))[0]
+    psd_matrix = np.stack([psd for _, psd in psd_cache.values()])
+    edges = [band_slice(f_psd, low, high) for low, high in BANDS.values()]
+    lo = np.array([sl.start for sl in edges])
+    hi = np.array([sl.stop for sl in edges])
+    csum = np.zeros((psd_matrix.shape[0], psd_matrix.shape[1] + 1))
+    np.cumsum(psd_matrix, axis=1, out=csum[:, 1:])
+    table_db = to_db((csum[:, hi] - csum[:, lo]) / (hi - lo), 1e-12)
+
+    for name, band_powers in zip(psd_cache, table_db):
+        print(f"{name:<20}" + "".join(f" {bp:>10.1f}" for bp in band_powers))
+
+def main():
+    # Load data
+    csv_path = 'state_transition_dac.csv'
+    if not os.path.exists(csv_path):
+        print(f"ERROR: {csv_path} not found!")
+        return
+
+    print(f"Loading {csv_path}...")
+    cols = load_columns(csv_path, ['dac_output', 'phase', 'mu_l5b'])
+    n_rows = len(cols['dac_output'])
+    print(f"  Loaded {n_rows} samples ({n_rows/1000:.1f} seconds at 1 kHz)")
+
+    # Extract DAC output (already mixed by Verilog)
+    dac_raw = cols['dac_output']
+    mu_values = cols['mu_l5b']
+
+    # Convert 12-bit DAC to float [-1, 1]
+    dac_float = dac_to_float(dac_raw)
+    time_axis = np.arange(len(dac_float)) / FS
+
+    # Create output directory
+    os.makedirs('eeg_analysis', exist_ok=True)
+
+    # One spectrogram and one set of phase PSDs feed every figure and the summary
+    spec = compute_spectrogram(dac_float)
+    print("Computing PSDs for each phase...")
+    psd_cache = compute_phase_psds(dac_float)
 
-        row = f"{name:<20}"
-        for band_name, (low, high) in bands.items():
-            band_mask = (f_psd >= low) & (f_psd <= high)
-            band_power = 10 * np.log10(np.mean(psd[band_mask]) + 1e-12)
-            row += f" {band_power:>10.1f}"
-        print(row)
+    plot_waveform(dac_float, time_axis)
+    plot_spectrogram(spec)
+    plot_psd_comparison(psd_cache)
+    plot_band_timeline(spec, time_axis, mu_values)
+    print_summary(dac_raw, psd_cache)
 
     print("\n" + "="*70)
     print("Analysis complete! Output files in: eeg_analysis/")
@@ -25,11 +25,57 @@ Usage:
 """
 
 import numpy as np
-import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Headless: these scripts only write PNGs
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 from scipy import signal
+from scipy.fft import set_workers
 import os
 
+from analysis_common import (cupy, cusignal, load_columns, dac_to_float, to_db,
+                             minmax_envelope, band_slice, band_powers_db,
+                             draw_phase_lines, draw_band_lines, db_colorbar)
+
+# Spectrogram parameters
+# Use 4-second window for good frequency resolution at low frequencies
+NPERSEG = 4096  # 4 second window at 1 kHz
+NOVERLAP = 3584  # 87.5% overlap for smooth time resolution
+STFT_WINDOW = signal.get_window('hamming', NPERSEG)  # Built once
+
+# State timeline is drawn as a min/max envelope of this many buckets
+ENVELOPE_BUCKETS = 6000
+
+def chunked_spectrogram(x, fs, window, noverlap, block_cols=128):
+    """signal.spectrogram filled block-by-block into a preallocated float32 array.
+
+    Segment k always starts at k*step, so each block of columns is exactly the
+    matching slice of the full-length result, while only block_cols windowed
+    segments (and their FFTs) are alive at a time.
+    """
+    nperseg = len(window)
+    if len(x) < nperseg:
+        # Recording shorter than one window: a single Hamming segment over all of it
+        f, t, Sxx = signal.spectrogram(x, fs, window='hamming', nperseg=len(x),
+                                       noverlap=min(noverlap, len(x) - 1))
+        return f, t, Sxx.astype(np.float32, copy=False)
+    step = nperseg - noverlap
+    n_cols = (len(x) - noverlap) // step
+    Sxx = np.empty((nperseg // 2 + 1, n_cols), dtype=np.float32)
+    for c0 in range(0, n_cols, block_cols):
+        c1 = min(c0 + block_cols, n_cols)
+        span = x[c0 * step:(c1 - 1) * step + nperseg]
+        f, _, block = signal.spectrogram(span, fs, window=window, noverlap=noverlap)
+        Sxx[:, c0:c1] = block
+    t = (np.arange(n_cols) * step + nperseg / 2) / fs
+    return f, t, Sxx
+
+def gpu_spectrogram(x, fs, window, noverlap):
+    """signal.spectrogram on the GPU via cusignal; results come back as NumPy."""
+    f, t, Sxx = cusignal.spectrogram(cupy.asarray(x), fs,
+                                     window=cupy.asarray(window), noverlap=noverlap)
+    return cupy.asnumpy(f), cupy.asnumpy(t), cupy.asnumpy(Sxx).astype(np.float32, copy=False)
+
 def main():
     # Load DAC output
     csv_path = 'state_transition_dac.csv'
@@ -42,34 +88,32 @@ def main():
         return
 
     print(f"Loading {csv_path}...")
-    df = pd.read_csv(csv_path)
-    print(f"  Loaded {len(df)} samples ({len(df)/1000:.1f} seconds at 1 kHz)")
+    cols = load_columns(csv_path, ['dac_output', 'phase', 'state_select', 'mu_l5b'])
+    n_rows = len(cols['dac_output'])
+    print(f"  Loaded {n_rows} samples ({n_rows/1000:.1f} seconds at 1 kHz)")
 
     # Parameters
     fs = 1000  # 1 kHz sample rate
-    dac_values = df['dac_output'].values
-    phases = df['phase'].values
+    dac_values = cols['dac_output']
+    phases = cols['phase']
     # v11.4: Changed from mu_l5b to state_select
-    state_values = df['state_select'].values if 'state_select' in df.columns else df.get('mu_l5b', np.zeros(len(df))).values
+    state_values = cols.get('state_select', cols.get('mu_l5b', np.zeros(n_rows)))
 
     # Auto-detect duration from data (5 equal phases)
-    total_duration = len(df) / fs  # Total seconds
+    total_duration = n_rows / fs  # Total seconds
     phase_duration = total_duration / 5  # Each phase duration
     print(f"  Duration: {total_duration:.0f}s total, {phase_duration:.0f}s per phase")
 
     # Convert 12-bit DAC to float [-1, 1]
-    dac_float = (dac_values.astype(float) - 2048) / 2048
-
-    # Generate spectrogram
-    # Use 4-second window for good frequency resolution at low frequencies
-    nperseg = 4096  # 4 second window at 1 kHz
-    noverlap = 3584  # 87.5% overlap for smooth time resolution
+    dac_float = dac_to_float(dac_values)
 
+    # Generate spectrogram: cuFFT when available, else the FFT batch spread over all cores
     print("Computing spectrogram...")
-    f, t, Sxx = signal.spectrogram(dac_float, fs,
-                                    nperseg=nperseg,
-                                    noverlap=noverlap,
-                                    window='hamming')
+    if cusignal is not None:
+        f, t, Sxx = gpu_spectrogram(dac_float, fs, STFT_WINDOW, NOVERLAP)
+    else:
+        with set_workers(-1):
+            f, t, Sxx = chunked_spectrogram(dac_float, fs, STFT_WINDOW, NOVERLAP)
 
     # Create output directory if needed
     os.makedirs('eeg_analysis', exist_ok=True)
@@ -81,14 +125,15 @@ def main():
 
     ax1 = axes[0]
 
-    # Limit to 0-80 Hz (covers all relevant EEG bands)
-    freq_mask = f <= 80
+    # Limit to 0-80 Hz (covers all relevant EEG bands); a row view, no copy
+    rows = band_slice(f, 0, 80)
+    f_plot = f[rows]
 
-    # Plot spectrogram
-    power_db = 10 * np.log10(Sxx[freq_mask, :] + 1e-10)
-    im = ax1.pcolormesh(t, f[freq_mask], power_db,
-                        shading='gouraud', cmap='viridis',
-                        vmin=-60, vmax=-20)
+    # Plot spectrogram: the norm applies the log scale (-60..-20 dB) at colormap lookup
+    im = ax1.imshow(Sxx[rows], aspect='auto', origin='lower',
+                    extent=[t[0], t[-1], f_plot[0], f_plot[-1]],
+                    interpolation='bilinear', cmap='viridis',
+                    norm=LogNorm(vmin=1e-6, vmax=1e-2), rasterized=True)
 
     # φⁿ frequency markers (golden ratio architecture)
     phi_freqs = {
@@ -110,11 +155,10 @@ def main():
     phase_names = ['NORMAL', 'N→M', 'MEDITATION', 'M→N', 'NORMAL']
     phase_colors = ['#00ff00', '#ffff00', '#0080ff', '#ffff00', '#00ff00']
 
-    for i, (start, end) in enumerate(zip(phase_times[:-1], phase_times[1:])):
-        # Phase boundary line
-        if i > 0:
-            ax1.axvline(start, color='red', linestyle='-', alpha=0.6, linewidth=2)
+    # Phase boundary lines
+    draw_phase_lines(ax1, phase_times[1:-1], colors='red', alpha=0.6, linewidths=2)
 
+    for i, (start, end) in enumerate(zip(phase_times[:-1], phase_times[1:])):
         # Phase label
         mid = (start + end) / 2
         ax1.text(mid, 75, phase_names[i], ha='center', va='top',
@@ -129,20 +173,21 @@ def main():
     ax1.set_xlim(0, total_duration)
     ax1.set_ylim(0, 80)
 
-    plt.colorbar(im, ax=ax1, label='Power (dB)', shrink=0.8)
+    db_colorbar(im, ax1, shrink=0.8)
 
     #=========================================================================
     # Plot 2: State Select Timeline
     #=========================================================================
     ax2 = axes[1]
 
-    time_axis = np.arange(len(state_values)) / 1000  # Convert to seconds
-    ax2.plot(time_axis, state_values, 'b-', linewidth=1.5, label='state_select (0=NORMAL, 4=MEDITATION)')
-    ax2.fill_between(time_axis, 0, state_values, alpha=0.3)
+    # Min/max envelope instead of one vertex per sample; the edge stroke stands in for the line
+    env_t, env_lo, env_hi = minmax_envelope(state_values, fs, ENVELOPE_BUCKETS)
+    ax2.fill_between(env_t, env_lo, env_hi, color='b', linewidth=1.5,
+                     label='state_select (0=NORMAL, 4=MEDITATION)')
+    ax2.fill_between(env_t, 0, env_hi, alpha=0.3)
 
     # Phase boundary markers
-    for i, start in enumerate(phase_times[1:-1], 1):
-        ax2.axvline(start, color='red', linestyle='--', alpha=0.6, linewidth=1)
+    draw_phase_lines(ax2, phase_times[1:-1], colors='red', linestyles='--', alpha=0.6, linewidths=1)
 
     ax2.set_xlabel('Time (s)', fontsize=12)
     ax2.set_ylabel('State', fontsize=12)
@@ -161,7 +206,8 @@ def main():
     plt.tight_layout()
 
     output_path = 'eeg_analysis/state_transition_spectrogram.png'
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
+    fig.savefig(output_path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
     print(f"Saved: {output_path}")
 
     #=========================================================================
@@ -179,35 +225,38 @@ def main():
 
     colors = ['purple', 'green', 'orange', 'red']
 
-    for (band_name, (low, high)), color in zip(bands.items(), colors):
-        # Find frequency indices for this band
-        band_mask = (f >= low) & (f <= high)
-        # Average power in band over time
-        band_power = 10 * np.log10(np.mean(Sxx[band_mask, :], axis=0) + 1e-10)
-        ax3.plot(t, band_power, color=color, linewidth=1.5, label=band_name, alpha=0.8)
+    # Frequency index range for each band (f is monotonic, so each band is a row range)
+    band_slices = [band_slice(f, low, high) for low, high in bands.values()]
+    lo = np.array([sl.start for sl in band_slices])
+    hi = np.array([sl.stop for sl in band_slices])
+
+    # Average power in each band over time, in dB
+    band_db = band_powers_db(Sxx, lo, hi, 1e-10)
+
+    band_handles = draw_band_lines(ax3, t, band_db, colors, list(bands))
 
     # Phase boundary markers
-    for start in phase_times[1:-1]:
-        ax3.axvline(start, color='gray', linestyle='--', alpha=0.6, linewidth=1)
+    draw_phase_lines(ax3, phase_times[1:-1], colors='gray', linestyles='--', alpha=0.6, linewidths=1)
 
     ax3.set_xlabel('Time (s)', fontsize=12)
     ax3.set_ylabel('Band Power (dB)', fontsize=12)
     ax3.set_title('Band Power Over Time During State Transitions', fontsize=14)
     ax3.set_xlim(0, total_duration)
-    ax3.legend(loc='upper right')
+    ax3.legend(handles=band_handles, loc='upper right')
     ax3.grid(True, alpha=0.3)
 
-    # Add phase labels
+    # Add phase labels (height read once; get_ylim forces an autoscale pass)
+    ypos = ax3.get_ylim()[1] - 2
     for i, (start, end) in enumerate(zip(phase_times[:-1], phase_times[1:])):
         mid = (start + end) / 2
-        ypos = ax3.get_ylim()[1] - 2
         ax3.text(mid, ypos, phase_names[i], ha='center', fontsize=10,
                 fontweight='bold', alpha=0.7)
 
     plt.tight_layout()
 
     output_path2 = 'eeg_analysis/state_transition_band_power.png'
-    plt.savefig(output_path2, dpi=150, bbox_inches='tight')
+    fig2.savefig(output_path2, dpi=150, bbox_inches='tight')
+    plt.close(fig2)
     print(f"Saved: {output_path2}")
 
     #=========================================================================
@@ -217,19 +266,30 @@ def main():
     print("SUMMARY: Band Power Changes by Phase")
     print("="*60)
 
+    # Time column range of each phase (t is monotonic: [start, end)), found once
+    phase_time_slices = [tuple(np.searchsorted(t, [start, end], side='left'))
+                         for start, end in zip(phase_times[:-1], phase_times[1:])]
+    t0s = np.array([t0 for t0, _ in phase_time_slices])
+    t1s = np.array([t1 for _, t1 in phase_time_slices])
+
+    # Every (band, phase) block mean from one 2-D cumulative sum over the band rows
+    top = hi.max()
+    csum = np.zeros((top + 1, Sxx.shape[1] + 1))
+    np.cumsum(Sxx[:top], axis=0, dtype=np.float64, out=csum[1:, 1:])
+    np.cumsum(csum[1:, 1:], axis=1, out=csum[1:, 1:])
+    block = (csum[np.ix_(hi, t1s)] - csum[np.ix_(lo, t1s)]
+             - csum[np.ix_(hi, t0s)] + csum[np.ix_(lo, t0s)])
+    counts = np.outer(hi - lo, np.maximum(t1s - t0s, 1))
+    table_db = to_db(block / counts, 1e-10)
+
     for i, (phase_name, start, end) in enumerate(zip(phase_names, phase_times[:-1], phase_times[1:])):
-        # Find time indices for this phase
-        t_mask = (t >= start) & (t < end)
-        if not np.any(t_mask):
+        if t1s[i] <= t0s[i]:
             continue
 
         print(f"\nPhase {i}: {phase_name} ({start}-{end}s)")
         print("-" * 40)
 
-        for band_name, (low, high) in bands.items():
-            band_mask = (f >= low) & (f <= high)
-            phase_power = Sxx[band_mask, :][:, t_mask]
-            mean_power = 10 * np.log10(np.mean(phase_power) + 1e-10)
+        for band_name, mean_power in zip(bands, table_db[:, i]):
             print(f"  {band_name}: {mean_power:.1f} dB")
 
     print("\n" + "="*60)
@@ -9,13 +9,14 @@ Usage:
     python scripts/visualize_state_characterization.py state_results.txt
 """
 
+import os
 import sys
-import re
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Patch
-from matplotlib.gridspec import GridSpec
-import matplotlib.colors as mcolors
+
+# Only bring up a GUI backend when someone can see the window; batch runs
+# (CI/cron, redirected output) just write the PNG and PDF. Matplotlib itself is
+# imported in main(), after the input has been parsed.
+INTERACTIVE = sys.stdout.isatty() and bool(os.environ.get('DISPLAY'))
 
 # State definitions
 STATES = ['NORMAL', 'ANESTHESIA', 'PSYCHEDELIC', 'FLOW', 'MEDITATION']
@@ -36,101 +37,136 @@ MU_VALUES = {
     'MEDITATION':  {'theta': 6, 'l23': 2, 'l6': 6, 'l5a': 2, 'l5b': 2, 'l4': 2},
 }
 
-def parse_output(filename):
-    """Parse testbench output file."""
-    with open(filename, 'r') as f:
-        content = f.read()
+# MU heatmap layout (layers bottom-up through the column), built once at import
+MU_LAYERS = ['theta', 'l6', 'l5b', 'l5a', 'l4', 'l23']
+MU_LAYER_LABELS = ['Theta\n(Thalamus)', 'L6\n(Alpha)', 'L5b\n(H.Beta)',
+                   'L5a\n(L.Beta)', 'L4\n(Boundary)', 'L2/3\n(Gamma)']
+MU_MATRIX = np.array([[MU_VALUES[s][l] for l in MU_LAYERS] for s in STATES], dtype=np.int8)
+
+# Testbench summary rows: row label -> metric key
+METRIC_ROWS = {
+    'Theta cycles/2s': 'theta_cycles',
+    'Learn events/2s': 'learn_events',
+    'Recall events/2s': 'recall_events',
+    'Weight delta': 'weight_delta',
+    'Unique patterns': 'unique_patterns',
+    'Transitions/8k': 'transitions',
+    'Theta (thalamus)': 'theta_amp',
+    'Gamma (L2/3)': 'gamma_amp',
+    'Alpha (L6)': 'alpha_amp',
+    # NEW: Oscillator-derived pattern metrics
+    'Unique osc patterns': 'osc_unique',
+    'Osc transitions/8k': 'osc_transitions',
+    'Learn/theta (x100)': 'learn_rate',
+}
+# Recall accuracy rows, printed as N/6 per state
+RECALL_ROWS = {f'Recall {letter}': f'recall_{letter}' for letter in ['A', 'B', 'C']}
+
+# Column order of the per-state metric table
+METRICS = list(METRIC_ROWS.values()) + list(RECALL_ROWS.values())
+METRIC_INDEX = {m: i for i, m in enumerate(METRICS)}
 
+def parse_output(filename):
+    """Parse testbench output file in a single streaming pass over its lines."""
     data = {state: {} for state in STATES}
+    # Histograms as (states, 64) count arrays, row = state index; unexported rows stay 0
+    histograms = np.zeros((len(STATES), 64), dtype=np.int32)       # CA3 output
+    osc_histograms = np.zeros((len(STATES), 64), dtype=np.int32)   # Oscillator-derived (STATE-DEPENDENT!)
+    filled, osc_filled = set(), set()  # State rows already exported
 
-    # Parse learning dynamics
-    patterns = {
-        'theta_cycles': r'Theta cycles/2s\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'learn_events': r'Learn events/2s\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'recall_events': r'Recall events/2s\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'weight_delta': r'Weight delta\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'unique_patterns': r'Unique patterns\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'transitions': r'Transitions/8k\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'theta_amp': r'Theta \(thalamus\)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'gamma_amp': r'Gamma \(L2/3\)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'alpha_amp': r'Alpha \(L6\)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        # NEW: Oscillator-derived pattern metrics
-        'osc_unique': r'Unique osc patterns\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'osc_transitions': r'Osc transitions/8k\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-        'learn_rate': r'Learn/theta \(x100\)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)',
-    }
+    # Open histogram export block: (target array, filled rows, state index, bin prefix),
+    # and whether it has written any bins (the first non-empty export per state wins)
+    block = None
+    wrote = False
 
-    for key, pattern in patterns.items():
-        match = re.search(pattern, content)
-        if match:
-            values = [int(match.group(i+1)) for i in range(5)]
-            for i, state in enumerate(STATES):
-                data[state][key] = values[i]
-
-    # Parse recall accuracy
-    for letter in ['A', 'B', 'C']:
-        pattern = rf'Recall {letter}\s+(\d+)/6\s+(\d+)/6\s+(\d+)/6\s+(\d+)/6\s+(\d+)/6'
-        match = re.search(pattern, content)
-        if match:
-            values = [int(match.group(i+1)) for i in range(5)]
-            for i, state in enumerate(STATES):
-                data[state][f'recall_{letter}'] = values[i]
-
-    # Parse histograms (CA3 output)
-    histograms = {}
-    for state_idx, state in enumerate(STATES):
-        pattern = rf'HISTOGRAM_EXPORT state={state_idx}\n((?:\s+bin\[\d+\] = \d+\n)+)'
-        match = re.search(pattern, content)
-        if match:
-            hist = np.zeros(64)
-            for line in match.group(1).strip().split('\n'):
-                bin_match = re.match(r'\s*bin\[(\d+)\] = (\d+)', line)
-                if bin_match:
-                    bin_idx = int(bin_match.group(1))
-                    count = int(bin_match.group(2))
-                    hist[bin_idx] = count
-            histograms[state] = hist
-
-    # Parse oscillator-derived histograms (STATE-DEPENDENT!)
-    osc_histograms = {}
-    for state_idx, state in enumerate(STATES):
-        pattern = rf'OSC_HISTOGRAM_EXPORT state={state_idx}\n((?:\s+osc_bin\[\d+\] = \d+\n)+)'
-        match = re.search(pattern, content)
-        if match:
-            hist = np.zeros(64)
-            for line in match.group(1).strip().split('\n'):
-                bin_match = re.match(r'\s*osc_bin\[(\d+)\] = (\d+)', line)
-                if bin_match:
-                    bin_idx = int(bin_match.group(1))
-                    count = int(bin_match.group(2))
-                    hist[bin_idx] = count
-            osc_histograms[state] = hist
+    with open(filename, 'r') as f:
+        for line in f:
+            stripped = line.strip()
+
+            # Inside an export block: consume "bin[i] = v" lines until one doesn't match
+            if block is not None:
+                target, done, row, prefix = block
+                if stripped.startswith(prefix):
+                    bin_idx, _, count = stripped[len(prefix):].partition('] = ')
+                    if bin_idx.isdigit() and count.isdigit():
+                        if row not in done:
+                            target[row, int(bin_idx)] = int(count)
+                            wrote = True
+                        continue
+                if wrote:
+                    done.add(row)
+                block = None
+                wrote = False
+
+            # Export headers: "HISTOGRAM_EXPORT state=K" / "OSC_HISTOGRAM_EXPORT state=K"
+            head, sep, state_idx = stripped.rpartition(' state=')
+            if sep and head.endswith('HISTOGRAM_EXPORT') and state_idx.isdigit():
+                if int(state_idx) < len(STATES):
+                    if head.endswith('OSC_HISTOGRAM_EXPORT'):
+                        block = (osc_histograms, osc_filled, int(state_idx), 'osc_bin[')
+                    else:
+                        block = (histograms, filled, int(state_idx), 'bin[')
+                continue
+
+            # Learning dynamics and recall rows: dispatch on the row label
+            # (everything before the five per-state values)
+            tokens = stripped.split()
+            if len(tokens) < 6:
+                continue
+            label = ' '.join(tokens[:-5])
+            if label in METRIC_ROWS:
+                key = METRIC_ROWS[label]
+                fields = tokens[-5:]
+            elif label in RECALL_ROWS:
+                key = RECALL_ROWS[label]
+                fields = [tok[:-2] for tok in tokens[-5:] if tok.endswith('/6')]
+            else:
+                continue
+            # First occurrence wins (e.g. the cortical Transitions/8k row follows the CA3 one)
+            if key in data[STATES[0]] or len(fields) != 5 or not all(v.isdigit() for v in fields):
+                continue
+            for state, v in zip(STATES, fields):
+                data[state][key] = int(v)
 
     return data, histograms, osc_histograms
 
-def compute_entropy(histogram):
-    """Compute Shannon entropy from histogram."""
-    total = np.sum(histogram)
-    if total == 0:
-        return 0
-    probs = histogram[histogram > 0] / total
-    return -np.sum(probs * np.log2(probs))
+def entropies_batch(hist_arr):
+    """Shannon entropy (bits) of each row of a (states, 64) histogram array.
+
+    Empty rows give 0.
+    """
+    H = hist_arr.astype(np.float64)
+    totals = H.sum(axis=1, keepdims=True)
+    P = np.divide(H, totals, out=np.zeros_like(H), where=totals > 0)
+    logP = np.log2(P, out=np.zeros_like(P), where=P > 0)
+    return -(P * logP).sum(axis=1) + 0.0  # + 0.0 turns -0.0 (empty rows) into 0.0
+
+def metric_table(data):
+    """Parsed metrics as a (states, metrics) array in METRICS column order; missing values are 0."""
+    return np.array([[data[s].get(m, 0) for m in METRICS] for s in STATES], dtype=np.float64)
+
+def style_state_axis(ax):
+    """One tick per state, with the shared rotated state-name labels."""
+    ax.set_xticks(np.arange(len(STATES)), STATES, rotation=15, ha='right')
 
-def create_radar_chart(ax, data, metrics, title):
+def create_radar_chart(ax, table, metrics, title):
     """Create radar/spider chart for state comparison."""
-    angles = np.linspace(0, 2*np.pi, len(metrics), endpoint=False).tolist()
-    angles += angles[:1]  # Complete the circle
+    # One extra point back at the start closes the polygon
+    angles = np.linspace(0, 2*np.pi, len(metrics) + 1)
+    angles[-1] = angles[0]
 
     ax.set_theta_offset(np.pi / 2)
     ax.set_theta_direction(-1)
 
-    for state in STATES:
-        values = [data[state].get(m, 0) for m in metrics]
-        # Normalize to 0-1 range
-        max_vals = [max(data[s].get(m, 0) for s in STATES) for m in metrics]
-        norm_values = [v/mv if mv > 0 else 0 for v, mv in zip(values, max_vals)]
-        norm_values += norm_values[:1]
+    # Normalize each metric to 0-1 by its max over states, for all states at once
+    values = table[:, [METRIC_INDEX[m] for m in metrics]]
+    max_vals = values.max(axis=0)
+    # Closed polygons for all states: column 0 repeated at the end
+    norm = np.zeros((len(STATES), len(metrics) + 1))
+    np.divide(values, max_vals, out=norm[:, :-1], where=max_vals > 0)
+    norm[:, -1] = norm[:, 0]
 
+    for state, norm_values in zip(STATES, norm):
         ax.plot(angles, norm_values, 'o-', linewidth=2,
                 label=state, color=STATE_COLORS[state])
         ax.fill(angles, norm_values, alpha=0.1, color=STATE_COLORS[state])
@@ -139,19 +175,14 @@ def create_radar_chart(ax, data, metrics, title):
     ax.set_xticklabels([m.replace('_', '\n') for m in metrics], size=8)
     ax.set_title(title, fontweight='bold', size=11, pad=15)
 
-def create_amplitude_bars(ax, data):
+def create_amplitude_bars(ax, table):
     """Create grouped bar chart for oscillator amplitudes."""
     x = np.arange(len(STATES))
     width = 0.25
 
-    # Get amplitudes and compute deltas from normal
-    normal_theta = data['NORMAL'].get('theta_amp', 0)
-    normal_gamma = data['NORMAL'].get('gamma_amp', 0)
-    normal_alpha = data['NORMAL'].get('alpha_amp', 0)
-
-    theta_delta = [(data[s].get('theta_amp', 0) - normal_theta) for s in STATES]
-    gamma_delta = [(data[s].get('gamma_amp', 0) - normal_gamma) for s in STATES]
-    alpha_delta = [(data[s].get('alpha_amp', 0) - normal_alpha) for s in STATES]
+    # Amplitude deltas from normal: one broadcast subtract of the NORMAL row
+    amps = table[:, [METRIC_INDEX['theta_amp'], METRIC_INDEX['gamma_amp'], METRIC_INDEX['alpha_amp']]]
+    theta_delta, gamma_delta, alpha_delta = (amps - amps[STATES.index('NORMAL')]).T
 
     bars1 = ax.bar(x - width, theta_delta, width, label='Theta (thalamus)',
                    color='#FF9999', edgecolor='black', linewidth=0.5)
@@ -164,41 +195,27 @@ def create_amplitude_bars(ax, data):
     ax.set_xlabel('Consciousness State')
     ax.set_ylabel('Amplitude Delta from Normal')
     ax.set_title('Oscillator Amplitude Modulation by State', fontweight='bold')
-    ax.set_xticks(x)
-    ax.set_xticklabels(STATES, rotation=15, ha='right')
+    style_state_axis(ax)
     ax.legend(loc='upper right', fontsize=8)
 
-    # Add value labels on bars
-    for bars in [bars1, bars2, bars3]:
-        for bar in bars:
-            height = bar.get_height()
-            if abs(height) > 10:
-                ax.annotate(f'{int(height):+d}',
-                           xy=(bar.get_x() + bar.get_width()/2, height),
-                           xytext=(0, 3 if height > 0 else -10),
-                           textcoords="offset points",
-                           ha='center', va='bottom' if height > 0 else 'top',
-                           fontsize=7)
+    # Add value labels on bars (only deltas larger than 10)
+    for bars, deltas in [(bars1, theta_delta), (bars2, gamma_delta), (bars3, alpha_delta)]:
+        ax.bar_label(bars, labels=[f'{int(h):+d}' if abs(h) > 10 else '' for h in deltas],
+                     padding=3, fontsize=7)
 
 def create_mu_heatmap(ax):
     """Create heatmap of MU parameter values by state."""
-    layers = ['theta', 'l6', 'l5b', 'l5a', 'l4', 'l23']
-    layer_labels = ['Theta\n(Thalamus)', 'L6\n(Alpha)', 'L5b\n(H.Beta)',
-                    'L5a\n(L.Beta)', 'L4\n(Boundary)', 'L2/3\n(Gamma)']
-
-    mu_matrix = np.array([[MU_VALUES[s][l] for l in layers] for s in STATES])
+    im = ax.imshow(MU_MATRIX, cmap='RdYlGn', aspect='auto', vmin=1, vmax=6)
 
-    im = ax.imshow(mu_matrix, cmap='RdYlGn', aspect='auto', vmin=1, vmax=6)
-
-    ax.set_xticks(np.arange(len(layers)))
+    ax.set_xticks(np.arange(len(MU_LAYERS)))
     ax.set_yticks(np.arange(len(STATES)))
-    ax.set_xticklabels(layer_labels, fontsize=8)
+    ax.set_xticklabels(MU_LAYER_LABELS, fontsize=8)
     ax.set_yticklabels(STATES, fontsize=9)
 
     # Add text annotations
     for i in range(len(STATES)):
-        for j in range(len(layers)):
-            val = mu_matrix[i, j]
+        for j in range(len(MU_LAYERS)):
+            val = MU_MATRIX[i, j]
             color = 'white' if val <= 2 or val >= 5 else 'black'
             ax.text(j, i, str(int(val)), ha='center', va='center',
                    color=color, fontweight='bold', fontsize=10)
@@ -207,44 +224,36 @@ def create_mu_heatmap(ax):
                  fontweight='bold', size=10)
 
     # Colorbar
-    cbar = plt.colorbar(im, ax=ax, shrink=0.8)
+    cbar = ax.figure.colorbar(im, ax=ax, shrink=0.8)
     cbar.set_label('MU Value', fontsize=8)
 
 def create_entropy_comparison(ax, histograms):
     """Create bar chart comparing entropy across states."""
-    entropies = [compute_entropy(histograms.get(s, np.zeros(64))) for s in STATES]
+    entropies = entropies_batch(histograms)
 
     bars = ax.bar(STATES, entropies, color=[STATE_COLORS[s] for s in STATES],
                   edgecolor='black', linewidth=1)
 
     ax.set_ylabel('Shannon Entropy (bits)')
     ax.set_title('Phase Pattern Entropy by State', fontweight='bold')
-    ax.set_xticklabels(STATES, rotation=15, ha='right')
+    style_state_axis(ax)
 
     # Add value labels
-    for bar, ent in zip(bars, entropies):
-        ax.annotate(f'{ent:.2f}',
-                   xy=(bar.get_x() + bar.get_width()/2, bar.get_height()),
-                   xytext=(0, 3),
-                   textcoords="offset points",
-                   ha='center', va='bottom', fontsize=9, fontweight='bold')
+    ax.bar_label(bars, fmt='%.2f', padding=3, fontsize=9, fontweight='bold')
 
     # Add expected ranking annotation
     ax.text(0.98, 0.95, 'Expected: PSYCH > NORM > ANES',
             transform=ax.transAxes, ha='right', va='top',
             fontsize=8, style='italic', color='gray')
 
-def create_recall_accuracy_chart(ax, data):
+def create_recall_accuracy_chart(ax, table):
     """Create stacked bar chart for recall accuracy."""
     x = np.arange(len(STATES))
     width = 0.6
 
-    recall_a = [data[s].get('recall_A', 0) for s in STATES]
-    recall_b = [data[s].get('recall_B', 0) for s in STATES]
-    recall_c = [data[s].get('recall_C', 0) for s in STATES]
-
-    # Average recall
-    avg_recall = [(a + b + c) / 3 for a, b, c in zip(recall_a, recall_b, recall_c)]
+    # Average recall over patterns A/B/C
+    recall_cols = [METRIC_INDEX[k] for k in RECALL_ROWS.values()]
+    avg_recall = table[:, recall_cols].mean(axis=1)
 
     bars = ax.bar(STATES, avg_recall, width,
                   color=[STATE_COLORS[s] for s in STATES],
@@ -254,18 +263,15 @@ def create_recall_accuracy_chart(ax, data):
     ax.set_title('Memory Recall Performance by State', fontweight='bold')
     ax.set_ylim(0, 6)
     ax.axhline(y=3, color='red', linestyle='--', linewidth=1, alpha=0.5, label='Chance level')
-    ax.set_xticklabels(STATES, rotation=15, ha='right')
+    style_state_axis(ax)
 
     # Add value labels
-    for bar, acc in zip(bars, avg_recall):
-        ax.annotate(f'{acc:.1f}/6',
-                   xy=(bar.get_x() + bar.get_width()/2, bar.get_height()),
-                   xytext=(0, 3),
-                   textcoords="offset points",
-                   ha='center', va='bottom', fontsize=9, fontweight='bold')
+    ax.bar_label(bars, fmt='%.1f/6', padding=3, fontsize=9, fontweight='bold')
 
 def create_state_signatures(ax):
     """Create text-based state signature summary."""
+    from matplotlib.patches import Rectangle
+
     ax.axis('off')
 
     signatures = {
@@ -279,7 +285,7 @@ def create_state_signatures(ax):
     y_positions = np.linspace(0.9, 0.1, len(STATES))
 
     for i, (state, sig) in enumerate(signatures.items()):
-        ax.add_patch(plt.Rectangle((0.02, y_positions[i]-0.08), 0.96, 0.16,
+        ax.add_patch(Rectangle((0.02, y_positions[i]-0.08), 0.96, 0.16,
                                    facecolor=STATE_COLORS[state], alpha=0.3,
                                    edgecolor=STATE_COLORS[state], linewidth=2))
         ax.text(0.05, y_positions[i], state, fontsize=11, fontweight='bold',
@@ -291,45 +297,33 @@ def create_state_signatures(ax):
     ax.set_ylim(0, 1)
     ax.set_title('State Signatures', fontweight='bold', size=12)
 
-def create_oscillator_entropy_comparison(ax, osc_histograms, data):
+def create_oscillator_entropy_comparison(ax, osc_entropy_by_state, table):
     """Create bar chart comparing oscillator-derived pattern entropy (state-dependent!)."""
-    entropies = []
-    transitions = []
-    unique_patterns = []
-
-    for state in STATES:
-        if state in osc_histograms:
-            ent = compute_entropy(osc_histograms[state])
-        else:
-            ent = 0
-        entropies.append(ent)
-
-        # Get transitions and unique patterns from data
-        trans = data[state].get('osc_transitions', 0)
-        uniq = data[state].get('osc_unique', 0)
-        transitions.append(trans)
-        unique_patterns.append(uniq)
+    entropies = np.array([osc_entropy_by_state[s] for s in STATES])
+
+    # Transitions and unique patterns from the metric table
+    transitions = table[:, METRIC_INDEX['osc_transitions']].astype(int)
+    unique_patterns = table[:, METRIC_INDEX['osc_unique']].astype(int)
 
     x = np.arange(len(STATES))
     width = 0.6
 
     # Normalize transitions for dual axis
-    max_trans = max(transitions) if max(transitions) > 0 else 1
+    max_trans = transitions.max() if transitions.max() > 0 else 1
 
     bars = ax.bar(x, entropies, width,
                   color=[STATE_COLORS[s] for s in STATES],
                   edgecolor='black', linewidth=1)
 
     # Add unique pattern count as text
-    for i, (bar, uniq, trans) in enumerate(zip(bars, unique_patterns, transitions)):
-        ax.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 0.05,
-               f'{uniq}p\n{trans}t', ha='center', va='bottom', fontsize=7)
+    ax.bar_label(bars, labels=[f'{uniq}p\n{trans}t' for uniq, trans in zip(unique_patterns, transitions)],
+                 padding=2, fontsize=7)
 
     ax.set_xticks(x)
     ax.set_xticklabels([s[:4] for s in STATES], rotation=0, fontsize=8)
     ax.set_ylabel('Entropy (bits)', fontsize=9)
     ax.set_title('Oscillator Pattern Entropy\n(State-Dependent!)', fontweight='bold', size=10)
-    ax.set_ylim(0, max(entropies) * 1.4 if entropies else 3)
+    ax.set_ylim(0, entropies.max() * 1.4 if len(entropies) else 3)
 
     # Add annotation explaining what this shows
     ax.text(0.5, -0.15, 'p=unique patterns, t=transitions/8k',
@@ -340,6 +334,19 @@ def main(filename):
     print(f"Parsing {filename}...")
     data, histograms, osc_histograms = parse_output(filename)
 
+    # Oscillator entropies computed once, shared by row 2 and the row-4 histograms
+    osc_entropy_by_state = dict(zip(STATES, entropies_batch(osc_histograms)))
+
+    # Scalar metrics as one (states, metrics) array for the chart functions
+    table = metric_table(data)
+
+    # Plotting stack imported only now, so usage errors and unreadable input exit fast
+    import matplotlib
+    if not INTERACTIVE:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec
+
     # Create figure with GridSpec
     fig = plt.figure(figsize=(16, 14))
     fig.suptitle('Consciousness State Characterization\nφⁿ Neural Architecture - FPGA Simulation Results',
@@ -353,11 +360,11 @@ def main(filename):
     create_mu_heatmap(ax1)
 
     ax2 = fig.add_subplot(gs[0, 1])
-    create_amplitude_bars(ax2, data)
+    create_amplitude_bars(ax2, table)
 
     ax3 = fig.add_subplot(gs[0, 2], projection='polar')
     learning_metrics = ['theta_cycles', 'learn_events', 'recall_events', 'unique_patterns', 'transitions']
-    create_radar_chart(ax3, data, learning_metrics, 'Learning Dynamics')
+    create_radar_chart(ax3, table, learning_metrics, 'Learning Dynamics')
     ax3.legend(loc='upper left', bbox_to_anchor=(1.1, 1.0), fontsize=7)
 
     # Row 2: CA3 Entropy, Oscillator Entropy (NEW!), Recall accuracy
@@ -366,10 +373,10 @@ def main(filename):
     ax4.set_title('CA3 Output Entropy\n(Memory Pattern)', fontweight='bold', size=10)
 
     ax5 = fig.add_subplot(gs[1, 1])
-    create_oscillator_entropy_comparison(ax5, osc_histograms, data)
+    create_oscillator_entropy_comparison(ax5, osc_entropy_by_state, table)
 
     ax6 = fig.add_subplot(gs[1, 2])
-    create_recall_accuracy_chart(ax6, data)
+    create_recall_accuracy_chart(ax6, table)
 
     # Row 3: State signatures (wide) + summary text
     ax7 = fig.add_subplot(gs[2, :2])
@@ -406,38 +413,45 @@ MEDITATION: Moderate sync
     for i, state in enumerate(key_states):
         ax = fig.add_subplot(gs[3, i])
 
-        if state in osc_histograms:
-            hist = osc_histograms[state]
-            nonzero_bins = np.where(hist > 0)[0]
-            if len(nonzero_bins) > 0:
-                ax.bar(nonzero_bins, hist[nonzero_bins],
-                      color=STATE_COLORS[state], edgecolor='black', linewidth=0.5)
-                ax.set_xlabel('Oscillator Pattern (6-bit)', fontsize=8)
-                ax.set_ylabel('Count', fontsize=8)
-                ax.set_title(f'{state} Oscillator Histogram', fontsize=9, fontweight='bold')
-
-                # Add entropy annotation
-                ent = compute_entropy(hist)
-                n_unique = len(nonzero_bins)
-                ax.text(0.95, 0.95, f'H={ent:.2f} bits\n{n_unique} unique',
-                       transform=ax.transAxes,
-                       ha='right', va='top', fontsize=8,
-                       bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+        hist = osc_histograms[STATES.index(state)]
+        nonzero_bins = np.where(hist > 0)[0]
+        if len(nonzero_bins) > 0:
+            # One step patch over the occupied bin range (bins centred on integers)
+            lo, hi = nonzero_bins[0], nonzero_bins[-1] + 1
+            ax.stairs(hist[lo:hi], np.arange(lo, hi + 1) - 0.5, fill=True,
+                      facecolor=STATE_COLORS[state], edgecolor='black', linewidth=0.5)
+            ax.set_xlabel('Oscillator Pattern (6-bit)', fontsize=8)
+            ax.set_ylabel('Count', fontsize=8)
+            ax.set_title(f'{state} Oscillator Histogram', fontsize=9, fontweight='bold')
+
+            # Add entropy annotation
+            ent = osc_entropy_by_state[state]
+            n_unique = len(nonzero_bins)
+            ax.text(0.95, 0.95, f'H={ent:.2f} bits\n{n_unique} unique',
+                   transform=ax.transAxes,
+                   ha='right', va='top', fontsize=8,
+                   bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
 
     # Save figure
     output_file = filename.replace('.txt', '_visualization.png')
     if output_file == filename:
         output_file = 'state_characterization_visualization.png'
 
-    plt.savefig(output_file, dpi=150, bbox_inches='tight', facecolor='white')
+    # Lay the figure out once; both formats reuse the same tight bounding box
+    # (bbox_inches='tight' would redo a full draw per savefig)
+    fig.canvas.draw()
+    tight_bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+
+    fig.savefig(output_file, dpi=150, bbox_inches=tight_bbox, facecolor='white')
     print(f"Saved visualization to {output_file}")
 
     # Also save as PDF for publication quality
     pdf_file = output_file.replace('.png', '.pdf')
-    plt.savefig(pdf_file, bbox_inches='tight', facecolor='white')
+    fig.savefig(pdf_file, bbox_inches=tight_bbox, facecolor='white')
     print(f"Saved PDF to {pdf_file}")
 
-    plt.show()
+    if INTERACTIVE:
+        plt.show()
 
 if __name__ == '__main__':
     if len(sys.argv) < 2: